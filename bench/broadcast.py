@@ -0,0 +1,59 @@
+'''
+Compare per-recipient broadcast cost: the old path (json.dumps + two writes per
+client) vs encode-once fan-out of a single frame.
+
+    python -m bench.broadcast
+'''
+import json
+import struct
+import time
+import timeit
+
+from cgf.framing import encode_frame
+
+
+class FakeWriter:
+    def __init__(self):
+        self.n_bytes = 0
+
+    def is_closing(self):
+        return False
+
+    def write(self, bs: bytes):
+        self.n_bytes += len(bs)
+
+
+def sample_msg() -> dict:
+    # roughly a PLAYER_READY / chat sized broadcast
+    return dict(type="SEND_CHAT", payload={"content": "gl hf everyone, first to 3 in a row wins"}, visibility="global",
+        **{"from": dict(uid="0123456789abcdef", username="SomePlayer", last_seen=time.time()), "ts": time.time()})
+
+
+def old_path(writers: list[FakeWriter], msg_j: dict):
+    for w in writers:
+        msg = json.dumps(msg_j)
+        w.write(struct.pack('<H', len(msg)))
+        w.write(bytes(msg, "UTF8"))
+
+
+def new_path(writers: list[FakeWriter], msg_j: dict):
+    frame = encode_frame(msg_j)
+    for w in writers:
+        w.write(frame)
+
+
+def main():
+    msg_j = sample_msg()
+    print(f"{'clients':>8} | {'old ns/recipient':>17} | {'new ns/recipient':>17} | speedup")
+    for n_clients in [1, 16, 64, 500]:
+        writers = [FakeWriter() for _ in range(n_clients)]
+        number = max(20, 20_000 // n_clients)
+        old_t = min(timeit.repeat(lambda: old_path(writers, msg_j), number=number, repeat=5))
+        new_t = min(timeit.repeat(lambda: new_path(writers, msg_j), number=number, repeat=5))
+        old_ns = old_t / number / n_clients * 1e9
+        new_ns = new_t / number / n_clients * 1e9
+        print(f"{n_clients:>8} | {old_ns:>17.1f} | {new_ns:>17.1f} | {old_ns / new_ns:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
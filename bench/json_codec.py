@@ -0,0 +1,60 @@
+'''
+Encode/decode micro-benchmark for our real message shapes: stdlib json (the old path:
+json.dumps + .encode / .decode + json.loads) vs cgf.json_codec.
+
+    python -m bench.json_codec
+'''
+import json
+import time
+import timeit
+
+from cgf import json_codec
+
+
+def user_j(i: int) -> dict:
+    return dict(uid=f"{i:016x}", username=f"Player{i}", last_seen=time.time())
+
+
+def room_info_j(i: int) -> dict:
+    return dict(name=f"Room {i}##abcd", player_limit=16, n_teams=2, n_players=5, is_public=True, is_open=True,
+        n_maps=25, min_secs=15, max_secs=45, max_difficulty="Expert", map_pack=None, use_totd=False,
+        game_start_time=-1, started=False, game_opts={"1st_round_for_center": "True", "cannot_repick": "True"},
+        use_club_room=False, cr_join_link="", ready_count=2, maps_loaded=True, join_code="ABC234")
+
+
+def map_j(i: int) -> dict:
+    return dict(TrackID=80000 + i, TrackUID=f"uid{i:024d}", Name=f"$s$oSome Map {i}", AuthorTime=42000 + i, Tags="Tech,FullSpeed",
+        TypeName="Race", StyleName="Tech", LengthName="45 secs", LengthSecs=45, LengthEnum=3, DifficultyName="Intermediate",
+        HasThumbnail=True)
+
+
+SHAPES = {
+    "MARK_READY (inbound)": dict(type="MARK_READY", payload={"ready": True}, visibility="global"),
+    "G_ game msg": {"type": "G_TAKE_SQUARE", "payload": {"col": 1, "row": 2, "seq": 123}, "visibility": "global", "from": user_j(1), "ts": time.time()},
+    "ROOM_INFO": dict(type="ROOM_INFO", payload=room_info_j(1)),
+    "PLAYER_LIST (64)": dict(type="PLAYER_LIST", payload={"players": [user_j(i) for i in range(64)]}),
+    "LOBBY_INFO (30 rooms)": dict(type="LOBBY_INFO", payload={"name": "TicTacGo", "n_clients": 120, "n_rooms": 40, "n_public_rooms": 30, "rooms": [room_info_j(i) for i in range(30)]}),
+    "MAPS_INFO_FULL (100)": dict(type="MAPS_INFO_FULL", payload={"maps": [map_j(i) for i in range(100)]}),
+}
+
+
+def bench(f, n: int) -> float:
+    return min(timeit.repeat(f, number=n, repeat=5)) / n * 1e6
+
+
+def main():
+    print(f"backend: {json_codec.BACKEND}")
+    print(f"{'shape':>22} | {'bytes':>6} | {'old enc us':>10} | {'new enc us':>10} | {'old dec us':>10} | {'new dec us':>10}")
+    for name, obj in SHAPES.items():
+        body = json_codec.dumps(obj)
+        old_body = json.dumps(obj).encode("UTF8")
+        n = max(50, 200_000 // len(body))
+        old_enc = bench(lambda: json.dumps(obj).encode("UTF8"), n)
+        new_enc = bench(lambda: json_codec.dumps(obj), n)
+        old_dec = bench(lambda: json.loads(old_body.decode("UTF8")), n)
+        new_dec = bench(lambda: json_codec.loads(body), n)
+        print(f"{name:>22} | {len(body):>6} | {old_enc:>10.2f} | {new_enc:>10.2f} | {old_dec:>10.2f} | {new_dec:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
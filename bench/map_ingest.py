@@ -0,0 +1,76 @@
+'''
+Map ingestion throughput against a real MongoDB (the one in .mongodb, in a throwaway db):
+the old path (find_one by TrackID then replace/save, per map) vs RandomMapCacher.upsert_maps
+(one bulk_write of upserts + one query for the ids of replaced maps).
+Each mode runs on an empty collection (all inserts) and again on the same maps (all replacements).
+
+    python -m bench.map_ingest [n_maps]
+'''
+import asyncio
+import sys
+import time
+
+from beanie import init_beanie
+from beanie.operators import Eq
+
+from cgf.db import db
+from cgf.models.Map import Map
+from cgf.RandomMapCacher import upsert_maps
+
+
+BENCH_DB_NAME = "cgf_bench_map_ingest"
+
+
+def fake_map_json(track_id: int) -> dict:
+    return dict(
+        TrackID=track_id, UserID=1, Username="bench", AuthorLogin="bench", Name=f"Bench {track_id}",
+        GbxMapName=f"Bench {track_id}", TrackUID=f"bench{track_id:020d}", TitlePack="TMStadium", ExeVersion="3.3.0",
+        ExeBuild="2022-01-01_00_00", Mood="Day", ModName=None, AuthorTime=45000, ParserVersion=2,
+        UploadedAt="2022-02-26T00:29:13", UpdatedAt="2022-02-26T00:29:13.657", Tags="1", TypeName="Race",
+        StyleName="Tech", RouteName="Single", LengthName="45 secs", DifficultyName="Intermediate", Laps=1,
+        Comments="", Downloadable=True, Unlisted=False, Unreleased=False, RatingVoteCount=0, RatingVoteAverage=0.0,
+        VehicleName="CarSport", EnvironmentName="Stadium", HasScreenshot=False, HasThumbnail=True, MapType="TM_Race",
+    )
+
+
+async def one_by_one(maps: list[Map]):
+    for _map in maps:
+        _map.id = None
+        map_in_db = await Map.find_one(Eq(Map.TrackID, _map.TrackID))
+        if map_in_db is not None:
+            _map.id = map_in_db.id
+            await _map.replace()
+        else:
+            await _map.save()
+
+
+async def bulk(maps: list[Map]):
+    for _map in maps:
+        _map.id = None
+    await upsert_maps(maps)
+
+
+async def measure(name: str, ingest, n_maps: int):
+    await Map.get_motor_collection().delete_many({})
+    maps = [Map(**fake_map_json(100_000_000 + i)) for i in range(n_maps)]
+    for phase in ("insert", "replace"):
+        start = time.perf_counter()
+        await ingest(maps)
+        duration = time.perf_counter() - start
+        assert all(m.id is not None for m in maps)
+        print(f"{name:>10} | {phase:>7} | {n_maps:>6} | {duration * 1000:>9.0f} | {n_maps / duration:>9.0f}")
+
+
+async def main():
+    n_maps = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    await init_beanie(database=db[BENCH_DB_NAME], document_models=[Map])
+    print(f"{'mode':>10} | {'phase':>7} | {'maps':>6} | {'ms':>9} | {'maps/s':>9}")
+    try:
+        await measure("one-by-one", one_by_one, n_maps)
+        await measure("bulk", bulk, n_maps)
+    finally:
+        await db.drop_database(BENCH_DB_NAME)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+'''
+Per-client periodic work at N connections: one `while: tick(); await asyncio.sleep(period)` task
+per client per loop (the old ping/info loops) vs a single cgf.scheduler.TimingWheel.
+Reports memory held by the timers/tasks (tracemalloc) and CPU time over a few periods.
+
+    python -m bench.scheduler [n_clients]
+'''
+import asyncio
+import sys
+import time
+import tracemalloc
+
+from cgf.scheduler import TimingWheel
+
+
+PERIOD = 0.5
+N_PERIODS = 6
+# ping + one of lobby/room/game info per client
+LOOPS_PER_CLIENT = 2
+
+
+class FakeClient:
+    def __init__(self):
+        self.n_ticks = 0
+        self.disconnected = False
+
+    def tick(self):
+        self.n_ticks += 1
+
+
+async def run_tasks(clients: list[FakeClient]):
+    async def loop(client: FakeClient):
+        while not client.disconnected:
+            client.tick()
+            await asyncio.sleep(PERIOD)
+    return [asyncio.create_task(loop(c)) for c in clients for _ in range(LOOPS_PER_CLIENT)]
+
+
+async def run_wheel(clients: list[FakeClient]):
+    wheel = TimingWheel(period=PERIOD)
+    for c in clients:
+        for _ in range(LOOPS_PER_CLIENT):
+            wheel.add(c.tick)
+    await asyncio.sleep(0)
+    return [wheel.task]
+
+
+async def measure(name: str, start, n_clients: int):
+    clients = [FakeClient() for _ in range(n_clients)]
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    tasks = await start(clients)
+    await asyncio.sleep(PERIOD)
+    mem = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    cpu0, wall0 = time.process_time(), time.perf_counter()
+    await asyncio.sleep(PERIOD * N_PERIODS)
+    cpu, wall = time.process_time() - cpu0, time.perf_counter() - wall0
+    for t in tasks: t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    n_ticks = sum(c.n_ticks for c in clients)
+    print(f"{name:>6} | {n_clients:>6} | {len(tasks):>6} | {mem / 1024:>9.0f} | {cpu / wall * 100:>7.1f} | {cpu / max(1, n_ticks) * 1e6:>10.2f}")
+
+
+async def main():
+    n_clients = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    print(f"period {PERIOD}s (server uses 5s; CPU scales down by the same factor), {LOOPS_PER_CLIENT} loops per client")
+    print(f"{'mode':>6} | {'conns':>6} | {'tasks':>6} | {'mem KiB':>9} | {'cpu %':>7} | {'us / tick':>10}")
+    await measure("tasks", run_tasks, n_clients)
+    await measure("wheel", run_wheel, n_clients)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
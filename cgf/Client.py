@@ -1,20 +1,19 @@
 import asyncio
-import json
+from collections import deque
+from datetime import datetime
 # from logging import debug, warn, warning, info
 import logging
 import os
 import random
-import struct
 import traceback
 from typing import Any, Literal, Optional, Union
 
 import pymongo
 from pydantic.dataclasses import dataclass
-from pydantic import Field
+from pydantic import Field, PrivateAttr
 
 from beanie import Document, PydanticObjectId, Link, Indexed
-from beanie.operators import GTE, Eq, In
-from beanie.exceptions import StateNotSaved
+from beanie.operators import GTE, LT, Eq, In
 import beanie
 from cgf.NadeoApi import await_maps_uploaded, create_club_room, delete_club_room, await_join_club_room, await_nadeo_services_initialized, get_club_room, join_club_room
 
@@ -25,15 +24,22 @@ from cgf.users import gen_join_code, gen_secret, gen_uid, gen_user_uid, get_user
 from cgf.consts import *
 from cgf.utils import *
 from cgf.op_auth import check_token
+from cgf import json_codec
+from cgf.framing import LEGACY_WIRE, MsgException, OutMsg, WireFormat, encode_frame_str
+from cgf.outbound import OutboundQueue, snapshot_key
+from cgf.connection import FrameProtocol
+from cgf.state import VersionedState
+from cgf.scheduler import TickFn, TickHandle, wheel
+from cgf.write_behind import WriteBehind
+from cgf.persistence import persist
+from cgf.retention import message_expiry
+from cgf.replay import ReplayChunks
+import cgf.registry as registry
 
 from .User import User
 from .consts import SERVER_VERSION
 
 
-class MsgException(Exception):
-    pass
-
-
 all_clients: set["Client"] = set()
 # updated in Lobby constructor
 all_lobbies: dict[str, "Lobby"] = dict()
@@ -64,21 +70,38 @@ class Message(Document):
     visibility: str = "global"
     user: Optional[Link[User]]
     ts: Indexed(float, pymongo.DESCENDING) = Field(default_factory=time.time)
+    # deleted by the TTL index after this; None = kept (see cgf.retention)
+    expire_at: Optional[datetime] = None
+    _safe_json: dict | None = PrivateAttr(default=None)
 
     class Settings:
-        indexes = ["type", "visibility"]
+        indexes = [
+            "type", "visibility",
+            pymongo.IndexModel([("expire_at", pymongo.ASCENDING)], name="expire_at_ttl", expireAfterSeconds=0),
+        ]
 
     def __getitem__(self, key):
         return self.payload[key]
     def __setitem__(self, key, value):
         self.payload[key] = value
 
-    def save_via_task(self):
-        asyncio.create_task(self.save())
+    def persist(self):
+        ''' queue for a batched insert; the id is assigned now so it can be linked to immediately '''
+        self.expire_at = message_expiry(self.type, self.ts)
+        message_writer.put(self)
 
     @property
     def safe_json(self):
-        return { "type": self.type, "payload": self.payload, "visibility": self.visibility, "from": None if self.user is None else self.user.safe_json, "ts": self.ts }
+        # cached for the life of the message; payload is shared so later writes to it are still seen
+        if self._safe_json is None:
+            self._safe_json = { "type": self.type, "payload": self.payload, "visibility": self.visibility, "from": None if self.user is None else self.user.safe_json, "ts": self.ts }
+        return self._safe_json
+
+
+# inbound messages that are never stored: logins, queries and connection set-up
+EPHEMERAL_MSG_TYPES = {"LIST_LOBBIES", "LIST_PLAYERS", "LIST_TEAMS", "STATE_RESYNC", "REJOIN_INTENT", "CAPABILITIES"}
+
+message_writer = WriteBehind(Message)
 
 
 class HasAdminsModel(Document):
@@ -191,7 +214,10 @@ class Room(HasAdminsModel):
 class GameSession(HasAdminsModel):
     name: Indexed(str, unique=True) = Field(default_factory=lambda: gen_uid(10))
     players: list[Link[User]]
-    game_msgs: list[Link[Message]] = Field(default_factory=list)
+    # game events live in GameEvent, with seq in [0, n_game_msgs)
+    n_game_msgs: int = 0
+    # pre-GameEvent schema (links to Message); moved to GameEvent by cgf.migrations.migrate_game_msgs
+    game_msgs: Optional[list[Any]] = None
     room: str
     lobby: str
     # list of player UIDs
@@ -218,7 +244,7 @@ class GameSession(HasAdminsModel):
     def to_full_game_info_json(self):
         ret = dict(
             players=[p.safe_json for p in self.players],
-            n_game_msgs=len(self.game_msgs),
+            n_game_msgs=self.n_game_msgs,
             teams=self.teams,
             team_order=self.team_order,
             map_list=self.map_list,
@@ -230,10 +256,108 @@ class GameSession(HasAdminsModel):
     @property
     def to_inprog_game_info_json(self):
         return dict(
-            n_game_msgs=len(self.game_msgs),
+            n_game_msgs=self.n_game_msgs,
         )
 
 
+class GameEvent(Document):
+    ''' One entry in a game's append-only log; (game, seq) is unique and seq is contiguous from 0. '''
+    game: str
+    seq: int
+    type: str
+    payload: dict
+    visibility: str = "global"
+    user: Optional[Link[User]]
+    # indexed for archival (cgf.retention)
+    ts: Indexed(float) = Field(default_factory=time.time)
+    _encoded: bytes | None = PrivateAttr(default=None)
+
+    class Settings:
+        indexes = [
+            pymongo.IndexModel(
+                [
+                    ("game", pymongo.ASCENDING),
+                    ("seq", pymongo.ASCENDING),
+                ],
+                name="game_seq_uniq",
+                unique=True,
+            ),
+        ]
+
+    @classmethod
+    def from_msg(cls, game: str, seq: int, msg: Message) -> "GameEvent":
+        return cls(game=game, seq=seq, type=msg.type, payload=msg.payload, visibility=msg.visibility, user=msg.user, ts=msg.ts)
+
+    @property
+    def safe_json(self):
+        return { "type": self.type, "payload": self.payload, "visibility": self.visibility, "from": None if self.user is None else self.user.safe_json, "ts": self.ts }
+
+    @property
+    def encoded(self) -> bytes:
+        ''' safe_json as JSON, encoded once and reused for every broadcast/replay '''
+        if self._encoded is None:
+            self._encoded = json_codec.dumps(self.safe_json)
+        return self._encoded
+
+    @property
+    def to_out_msg(self) -> OutMsg:
+        return OutMsg(self.safe_json, json_body=self.encoded)
+
+
+game_event_writer = WriteBehind(GameEvent)
+
+
+class GameSnapshot(Document):
+    ''' The latest client-submitted game-engine state for a game; it covers the log up to and including `seq`. '''
+    game: Indexed(str, unique=True)
+    seq: int
+    state: Any
+    by: str
+    ts: float = Field(default_factory=time.time)
+
+    @property
+    def to_replay_json(self):
+        return dict(seq=self.seq, state=self.state)
+
+
+class ChatLine(Document):
+    ''' One chat message in a lobby/room/game. The sender is stored by uid and looked up in all_users. '''
+    container_type: str
+    container_name: str
+    ts: float = Field(default_factory=time.time)
+    user_uid: Optional[str] = None
+    type: str = "SEND_CHAT"
+    payload: dict
+    visibility: str = "global"
+
+    class Settings:
+        indexes = [
+            pymongo.IndexModel(
+                [
+                    ("container_type", pymongo.ASCENDING),
+                    ("container_name", pymongo.ASCENDING),
+                    ("ts", pymongo.DESCENDING),
+                ],
+                name="container_ts",
+            ),
+            # for archival (cgf.retention)
+            pymongo.IndexModel([("ts", pymongo.ASCENDING)], name="ts"),
+        ]
+
+    @classmethod
+    def from_msg(cls, container_type: str, container_name: str, msg: Message) -> "ChatLine":
+        return cls(container_type=container_type, container_name=container_name, ts=msg.ts,
+            user_uid=None if msg.user is None else msg.user.uid, type=msg.type, payload=msg.payload, visibility=msg.visibility)
+
+    @property
+    def safe_json(self):
+        user = None if self.user_uid is None else get_user(self.user_uid)
+        return { "type": self.type, "payload": self.payload, "visibility": self.visibility, "from": None if user is None else user.safe_json, "ts": self.ts }
+
+
+chat_writer = WriteBehind(ChatLine)
+
+
 
 
 class HasClients:
@@ -254,23 +378,41 @@ class HasClients:
         self.broadcast_json({'type': type, 'payload': payload, 'visibility': "global"})
 
     def broadcast_json(self, msg_j: dict):
-        for client in self.clients:
-            client.write_json(msg_j)
+        if len(self.clients) == 0: return
+        self.broadcast_out(OutMsg(msg_j, snapshot_key(msg_j)))
+
+    def broadcast_out(self, out: OutMsg):
+        for client in list(self.clients):
+            client.write_out(out)
 
     def broadcast_player_left(self, the_client: "Client"):
-        msg_j = dict(type="PLAYER_LEFT", payload=the_client.user.safe_json)
-        for client in self.clients:
-            client.write_json(msg_j)
+        self.broadcast_json(dict(type="PLAYER_LEFT", payload=the_client.user.safe_json))
 
     def broadcast_player_joined(self, the_client: "Client"):
-        msg_j = dict(type="PLAYER_JOINED", payload=the_client.user.safe_json)
-        for client in self.clients:
-            client.write_json(msg_j)
+        self.broadcast_json(dict(type="PLAYER_JOINED", payload=the_client.user.safe_json))
 
     def tell_player_list(self, the_client: "Client"):
         msg_j = dict(type="PLAYER_LIST", payload={'players': [c.user.safe_json for c in self.clients]})
         the_client.write_json(msg_j)
 
+    state: VersionedState
+
+    def send_full_state(self, client: "Client"):
+        raise Exception("override .send_full_state")
+
+    def start_info_ticks(self, client: "Client"):
+        ''' Every wheel period while the client is here: re-check our state, and send the full state to legacy clients if it changed. '''
+        sent_version = -1
+        def tick():
+            nonlocal sent_version
+            if client not in self.clients or client.disconnected: return False
+            self.state.refresh()
+            # delta clients already got any changes
+            if not client.state_deltas and sent_version != self.state.version:
+                sent_version = self.state.version
+                self.send_full_state(client)
+        client.set_tick("info", tick)
+
 
 class HasAdmins(HasClients):
     model: HasAdminsModel
@@ -322,16 +464,10 @@ class HasAdmins(HasClients):
         self.mods.remove(user)
 
     def persist_model(self):
-        asyncio.create_task(self.persist_model_inner())
-
-    async def persist_model_inner(self):
-        try:
-            await self.model.save_changes()
-        except StateNotSaved as e:
-            pass
+        persist(self.model)
 
     def kick_this_client(self, client: "Client"):
-        for c in self.clients:
+        for c in list(self.clients):
             c.tell_info(f"Player Kicked: {client.user.name}")
 
     def send_admin_mod_status(self, client: "Client"):
@@ -411,17 +547,18 @@ class HasAdmins(HasClients):
         self.persist_model()
 
 
+N_RECENT_CHATS = 20
+
+
 class HasChats(HasAdmins):
-    chats: "ChatMessages" = None
-    recent_chat_msgs: list[Message]
+    recent_chat_msgs: deque[ChatLine]
     container_type: Literal["lobby", "room", "game"]
-    loaded_chat: bool
+    loaded_chat: asyncio.Event
 
     def __init__(self):
         super().__init__()
-        self.chats = None
-        self.recent_chat_msgs = list()
-        self.loaded_chat = False
+        self.recent_chat_msgs = deque(maxlen=N_RECENT_CHATS)
+        self.loaded_chat = asyncio.Event()
         asyncio.create_task(self.load_chat_msgs())
 
     @property
@@ -430,17 +567,16 @@ class HasChats(HasAdmins):
 
     async def load_chat_msgs(self):
         with timeit_context("Load Chats"):
-            if self.chats is not None: return
-            self.chats = await ChatMessages.find_one({self.container_type: self.name}, with_children=True)
-            if self.chats is None:
-                self.chats = ChatMessages(**{self.container_type: self.name, 'msgs': list()})
-                asyncio.create_task(self.chats.save())
-            n_msgs = len(self.chats.msgs)
-            start_ix = max(0, n_msgs - 20)
-            msg_ids = [self.chats.msgs[i].ref.id for i in range(start_ix, n_msgs)]
-            self.recent_chat_msgs = await Message.find(In(Message.id, msg_ids), fetch_links=True).to_list()
+            if self.loaded_chat.is_set(): return
+            lines = await ChatLine.find(
+                Eq(ChatLine.container_type, self.container_type), Eq(ChatLine.container_name, self.name)
+            ).sort(-ChatLine.ts).limit(N_RECENT_CHATS).to_list()
+            recent = deque(reversed(lines), maxlen=N_RECENT_CHATS)
+            # anything said while we were loading is newer
+            recent.extend(self.recent_chat_msgs)
+            self.recent_chat_msgs = recent
             log.info(f"[{self.container_type} | {self.name}] Loaded recent chats; nb: {len(self.recent_chat_msgs)}")
-            self.loaded_chat = True
+            self.loaded_chat.set()
 
     async def process_chat_msg(self, client: "Client", msg: Message):
         if msg.type == "SEND_CHAT": await self.on_chat_msg(client, msg)
@@ -453,10 +589,9 @@ class HasChats(HasAdmins):
             return client.tell_error(f"Chat message expects keys: {self.chat_msg_keys}")
         if not isinstance(msg['content'], str) or len(msg['content']) > 1024:
             return client.tell_error(f"Content wrong type or >1024 in length")
-        while len(self.recent_chat_msgs) > 19:
-            self.recent_chat_msgs.pop(0)
-        self.recent_chat_msgs.append(msg)
-        self.chats.append(msg)
+        line = ChatLine.from_msg(self.container_type, self.name, msg)
+        self.recent_chat_msgs.append(line)
+        chat_writer.put(line)
         self.broadcast_msg(msg)
 
     def send_recent_chat(self, client: "Client"):
@@ -470,9 +605,11 @@ class HasChats(HasAdmins):
 class RoomController(HasChats):
     model: Room
     game: Union["GameController", None] = None
-    loaded_game = False
-    loaded_maps = False
-    club_room_initialized = False
+    loaded_game: asyncio.Event
+    loaded_maps: asyncio.Event
+    club_room_initialized: asyncio.Event
+    # set whenever team membership changes or the room is retired
+    teams_changed: asyncio.Event
     lobby_inst: "Lobby"
     container_type: Literal["lobby", "room", "game"] = "room"
     players_ready: dict[str, bool]
@@ -490,16 +627,24 @@ class RoomController(HasChats):
         self.uid_to_teams = dict()
         self.teams = [list() for _ in range(self.model.n_teams)]
         self.maps = dict()
+        self.loaded_game = asyncio.Event()
+        self.loaded_maps = asyncio.Event()
+        self.club_room_initialized = asyncio.Event()
+        self.teams_changed = asyncio.Event()
         self.last_prep_status: dict = dict(msg="")
         self.map_load_error: RMC.MapPackNotFound | None = None
+        self.state = VersionedState(self.state_snapshot, self.on_state_delta)
         asyncio.create_task(self.load_game())
         asyncio.create_task(self.load_maps())
         asyncio.create_task(self.when_empty_retire_room())
         asyncio.create_task(self.init_room_with_status_msgs())
 
     async def initialized(self, club_room_too=False):
-        while not self.loaded_chat or not self.loaded_game or not self.loaded_maps or (club_room_too and not self.club_room_initialized):
-            await asyncio.sleep(0.01)
+        await self.loaded_chat.wait()
+        await self.loaded_game.wait()
+        await self.loaded_maps.wait()
+        if club_room_too:
+            await self.club_room_initialized.wait()
 
     async def load_game(self):
         game_model = await GameSession.find_one(
@@ -509,11 +654,10 @@ class RoomController(HasChats):
         )
         if game_model is not None:
             await game_model.fetch_all_links()
-            for msg in game_model.game_msgs:
-                asyncio.create_task(msg.fetch_all_links())
+            # the game's log is loaded when someone joins it
             game = GameController(game_model, room_inst=self)
             self.game = game
-        self.loaded_game = True
+        self.loaded_game.set()
 
     async def load_maps(self):
         # these maps (in the room) come back in a random order. Not the case for game session tho. IDK, weird
@@ -532,24 +676,30 @@ class RoomController(HasChats):
                         if self.model.use_totd \
                         else RMC.get_some_maps(maps_needed, self.model.min_secs, self.model.max_secs, self.model.max_difficulty)
                 # log.debug(f"Room asking for {maps_needed} maps.")
+                new_tids = list()
                 async for m in map_gen:
                     # log.debug(f"Got map: {m.json()}")
                     if (m.id is None):
                         await m.save()
                     self.model.map_list.append(m.TrackID)
                     self.maps[m.TrackID] = m
+                    new_tids.append(m.TrackID)
                 self.persist_model()
+                # players will download these soon
+                RMC.cache_maps(new_tids, RMC.PRIORITY_ROOM)
             except RMC.MapPackNotFound as e:
                 self.set_map_load_error(e)
-                self.loaded_maps = True
+                self.loaded_maps.set()
+                self.state.changed()
                 return
         if len(self.model.map_list) < self.model.maps_required:
             await self.load_maps()
         else:
             if self.game is not None:
                 self.game.model.map_list = self.model.map_list
-            self.loaded_maps = True
-            for client in self.clients:
+            self.loaded_maps.set()
+            self.state.changed()
+            for client in list(self.clients):
                 self.tell_maps_loaded_if_loaded(client)
 
     def set_map_load_error(self, e: RMC.MapPackNotFound):
@@ -574,15 +724,11 @@ class RoomController(HasChats):
 
     async def init_room_with_status_msgs(self):
         self.broadcast_preparation_status('Loading maps and initializing.')
-        while len(self.teams) == 0:
-            await asyncio.sleep(0.05)
-        while len(self.teams[0]) == 0:
-            await asyncio.sleep(0.05)
-        while not self.loaded_maps:
-            await asyncio.sleep(0.05)
+        if await self.wait_for_leader() is None: return
+        await self.loaded_maps.wait()
         if not self.model.use_club_room:
             self.broadcast_preparation_status('Ready when you are.')
-            self.club_room_initialized = True
+            self.club_room_initialized.set()
             return
         if self.map_load_error is not None:
             self.broadcast_preparation_status('Aborting room set up due to map load error.')
@@ -596,13 +742,13 @@ class RoomController(HasChats):
         random.shuffle(map_uids)
         await_maps_task = asyncio.create_task(await_maps_uploaded(map_uids))
         while not await_maps_task.done():
-            while (not self.model.is_retired and len(self.teams[0]) == 0):
-                await asyncio.sleep(0.05)
-            if self.model.is_retired: return
-            leader = self.teams[0][0]
+            leader = await self.wait_for_leader()
+            if leader is None: return
             leader.write_message("ENSURE_MAPS_NADEO", {'map_tids_uids': map_tids_and_uids})
-            while (len(self.teams[0]) > 0 and self.teams[0][0] == leader and not await_maps_task.done()):
-                await asyncio.sleep(0.05)
+            # ask the next leader if this one leaves before the maps are uploaded
+            leader_changed = asyncio.create_task(self.wait_for_leader(not_leader=leader))
+            await asyncio.wait([await_maps_task, leader_changed], return_when=asyncio.FIRST_COMPLETED)
+            leader_changed.cancel()
         room_resp = None
         if self.model.cr_activity_id < 0:
             self.broadcast_preparation_status('Creating room.')
@@ -610,7 +756,7 @@ class RoomController(HasChats):
             if room_resp is None:
                 self.broadcast_preparation_status('Error creating room.', True)
                 return
-            self.model.cr_activity_id = room_resp['activityId']
+            registry.set_cr_activity_id(self, room_resp['activityId'])
             self.persist_model()
         else:
             self.broadcast_preparation_status('Getting room details.')
@@ -628,7 +774,7 @@ class RoomController(HasChats):
         self.model.cr_join_link = join_link
         self.persist_model()
         self.broadcast_type_pl('SERVER_JOIN_LINK', {'join_link': join_link})
-        self.club_room_initialized = True
+        self.club_room_initialized.set()
         # wait for server to start and then clean up
         sleep_duration = 5.0
         await asyncio.sleep(sleep_duration)
@@ -677,7 +823,7 @@ class RoomController(HasChats):
         ret = self.model.to_created_room_json
         ret['n_players'] = len(self.clients)
         ret['ready_count'] = self.ready_count
-        ret['maps_loaded'] = self.loaded_maps
+        ret['maps_loaded'] = self.loaded_maps.is_set()
         return ret
 
     @property
@@ -725,19 +871,35 @@ class RoomController(HasChats):
     def tell_client_curr_scope(self, client: "Client"):
         client.set_scope(f"2|{self.name}")
 
-    async def room_info_loop(self, client: "Client"):
-        while client in self.clients and not client.disconnected:
-            self.send_room_info(client)
-            self.tell_player_list(client)
-            self.on_list_teams(client)
-            await asyncio.sleep(5.0)
+    def send_full_state(self, client: "Client"):
+        self.send_room_info(client)
+        self.tell_player_list(client)
+        self.on_list_teams(client)
 
     def send_room_info(self, client: "Client"):
         client.write_message("ROOM_INFO", self.to_created_room_json)
 
+    def state_snapshot(self) -> dict:
+        ret = self.to_created_room_json
+        ret['players'] = [dict(uid=c.user.uid, username=c.user.name) for c in self.clients]
+        ret['teams'] = self.teams_uids
+        ret['ready'] = {c.user.uid: self.players_ready.get(c.user.uid, False) for c in self.clients}
+        return ret
+
+    def on_state_delta(self, delta: dict):
+        out = OutMsg(dict(type="ROOM_DELTA", payload=delta))
+        for client in list(self.clients):
+            if client.state_deltas:
+                client.write_out(out)
+        self.lobby_inst.state.changed()
+
+    def send_state(self, client: "Client"):
+        if client.state_deltas:
+            client.write_message("ROOM_STATE", self.state.to_state_json)
+
     def tell_maps_loaded_if_loaded(self, client: "Client"):
         self.tell_client_map_load_error(client)
-        if self.loaded_maps:
+        if self.loaded_maps.is_set():
             client.write_message("MAPS_LOADED", dict())
             client.write_message("MAPS_PRELOAD", dict(maps=self.model.map_list))
 
@@ -755,12 +917,14 @@ class RoomController(HasChats):
         self.broadcast_player_left(client)
         if client in self.clients:
             self.clients.remove(client)
+        self.state.changed()
         self.lobby_inst.update_room_status(self)
 
     def on_client_entered(self, client: "Client"):
         self.tell_client_curr_scope(client)
         client.tell_info(f"Entered Room: {self.name}")
-        asyncio.create_task(self.room_info_loop(client))
+        self.start_info_ticks(client)
+        self.send_state(client)
         self.send_room_info(client)
         self.send_recent_chat(client)
         self.send_admin_mod_status(client)
@@ -771,6 +935,7 @@ class RoomController(HasChats):
         self.clients.add(client)
         self.assign_to_team(client)
         self.broadcast_player_joined(client)
+        self.state.changed()
         self.lobby_inst.update_room_status(self)
 
     def on_client_left(self, client: "Client"):
@@ -802,6 +967,7 @@ class RoomController(HasChats):
         elif msg.type == "LEAVE": return "LEAVE"
         elif msg.type == "FORCE_START": self.on_force_start(client, msg)
         elif msg.type == "JOIN_GAME_NOW": await self.on_join_game_now(client, msg)
+        elif msg.type == "STATE_RESYNC": self.send_state(client)
 
         # elif msg.type == "": await self.on_join_room(client, msg)
         # elif msg.type == "": await self.on_join_code(client, msg)
@@ -821,15 +987,28 @@ class RoomController(HasChats):
         self.uid_to_teams[client.user.uid] = tn
         if client not in self.teams[tn]:
             self.teams[tn].append(client)
+            self.teams_changed.set()
         self.broadcast_msg(Message(type="PLAYER_JOINED_TEAM", payload=dict(uid=client.user.uid, team=tn), visibility="global"))
         self.broadcast_player_ready(client)
         self.check_game_start_abort(client)
 
-    def on_list_teams(self, client: "Client", msg: Message = None):
-        teams = [[c.user.uid for c in team] for  team in self.teams]
+    async def wait_for_leader(self, not_leader: Union["Client", None] = None) -> Union["Client", None]:
+        ''' Wait till team 1 is led by someone other than `not_leader`; None if the room is retired first. '''
+        while not self.model.is_retired:
+            if len(self.teams) > 0 and len(self.teams[0]) > 0 and self.teams[0][0] is not not_leader:
+                return self.teams[0][0]
+            self.teams_changed.clear()
+            await self.teams_changed.wait()
+        return None
+
+    @property
+    def teams_uids(self) -> list[list[str]]:
         if self.game is not None:
-            teams = self.game.model.teams
-        client.write_message(type="LIST_TEAMS", payload={'teams': teams}, visibility="global")
+            return self.game.model.teams
+        return [[c.user.uid for c in team] for  team in self.teams]
+
+    def on_list_teams(self, client: "Client", msg: Message = None):
+        client.write_message(type="LIST_TEAMS", payload={'teams': self.teams_uids}, visibility="global")
         uids = [c.user.uid for c in self.clients]
         ready = [self.players_ready.get(c.user.uid, False) for c in self.clients]
         client.write_message(type="LIST_READY_STATUS", payload={'uids': uids, 'ready': ready}, visibility="global")
@@ -840,6 +1019,7 @@ class RoomController(HasChats):
         for team in self.teams:
             while client in team:
                 team.remove(client)
+                self.teams_changed.set()
 
     @HasAdmins.mod_only
     def on_update_game_opts(self, client: "Client", msg: Message):
@@ -857,8 +1037,9 @@ class RoomController(HasChats):
             self.model.player_limit = new_player_limit
             self.model.game_opts = game_opts
             self.persist_model()
+            self.state.changed()
             client.tell_info(f"Updated game options")
-            for c in self.clients:
+            for c in list(self.clients):
                 self.send_room_info(c)
         else:
             client.tell_warning(f"Could not load game options")
@@ -891,6 +1072,7 @@ class RoomController(HasChats):
         self.model.game_start_time = -1
         self.model.is_open = True
         self.persist_model()
+        self.state.changed()
         self.broadcast_msg(Message(type="GAME_START_ABORT", payload={}))
 
 
@@ -898,6 +1080,7 @@ class RoomController(HasChats):
         # log.debug(f"Setting player {client.user.uid} ready: {is_ready}")
         self.players_ready[client.user.uid] = is_ready
         self.ready_count = sum(1 if self.players_ready.get(c.user.uid, False) else 0 for c in self.clients)
+        self.state.changed()
 
     def broadcast_player_ready(self, client: "Client"):
         self.broadcast_msg(Message(type="PLAYER_READY", payload=dict(uid=client.user.uid, is_ready=self.players_ready[client.user.uid], ready_count=self.ready_count), visibility="global"))
@@ -918,6 +1101,9 @@ class RoomController(HasChats):
         self.model.game_start_time = start_time
         self.model.is_open = False
         self.persist_model()
+        self.state.changed()
+        # `started` flips once the start time passes
+        asyncio.get_running_loop().call_later(wait_time + 0.01, self.state.changed)
         msg_j = dict(type="GAME_STARTING_AT", payload={'start_time': start_time, 'wait_time': wait_time})
         self.broadcast_json(msg_j)
 
@@ -939,7 +1125,7 @@ class RoomController(HasChats):
             if any(len(t) == 0 for t in self.teams):
                 log.warn(f"Refusing to start game b/c a team is empty.")
                 self.abort_game_start()
-                for client in self.clients:
+                for client in list(self.clients):
                     client.tell_warning(f"Cannot start the game because a team is empty.")
                 return
             team_order = list(range(len(self.teams)))
@@ -966,12 +1152,24 @@ class RoomController(HasChats):
 
 
 
+# an empty game's log is dropped from memory after this long; it's reloaded when someone joins
+GAME_LOG_EVICT_SECS = 60 * 10
+# keeps GAME_REPLAY_START within a legacy frame
+MAX_SNAPSHOT_BYTES = 48 * 1024
+
+
 class GameController(HasChats):
     model: GameSession
     room: RoomController
     container_type: Literal["lobby", "room", "game"] = "game"
     teams: list[list["Client"]]
     track_id_to_players: dict[int, list["Client"]]
+    # in memory: seq in [log_base, n_game_msgs). Once loaded, log_base is replay_from (the first seq after the snapshot)
+    game_msgs: list[GameEvent]
+    log_base: int
+    log_loaded: bool
+    log_loading: asyncio.Task | None
+    snapshot: GameSnapshot | None
 
     @property
     def to_full_game_info_json(self):
@@ -995,11 +1193,71 @@ class GameController(HasChats):
         self.model = model
         self.room = room_inst
         super().__init__()
+        self.state = VersionedState(self.state_snapshot, self.on_state_delta)
         # clients assigned on joining the game
         self.teams = list(list() for _ in model.teams)
+        self.game_msgs = list()
+        self.log_base = self.model.n_game_msgs
+        self.log_loaded = self.log_base == 0
+        self.log_loading = None
+        self.snapshot = None
+        self.snapshot_lock = asyncio.Lock()
+        self.replay_chunks = ReplayChunks()
+        registry.register_game(self)
+        self.empty_since = time.time()
         self.fix_players_order()
-        if (len(self.model.game_msgs) == 0):
+        # a game that still has legacy game_msgs isn't new, it just wasn't migrated
+        if self.model.n_game_msgs == 0 and not self.model.game_msgs:
             self.broadcast_gm_reset()
+        elif self.model.game_msgs:
+            logging.warning(f"[Game {self.name}] has {len(self.model.game_msgs)} unmigrated game_msgs; not resetting it")
+        if self.log_loaded:
+            wheel.add(self.evict_log_tick)
+
+    async def ensure_log_loaded(self):
+        if self.log_loaded: return
+        if self.log_loading is None:
+            self.log_loading = asyncio.create_task(self.load_game_msgs())
+        await asyncio.shield(self.log_loading)
+
+    @property
+    def replay_from(self) -> int:
+        return 0 if self.snapshot is None else self.snapshot.seq + 1
+
+    async def load_game_msgs(self):
+        ''' load the snapshot, then stream seq in [replay_from, log_base); anything appended meanwhile is already in game_msgs '''
+        try:
+            with timeit_context(f"Load game log ({self.name})"):
+                if self.snapshot is None:
+                    self.snapshot = await GameSnapshot.find_one(Eq(GameSnapshot.game, self.name))
+                start, end = self.replay_from, self.log_base
+                events = list()
+                async for event in GameEvent.find(Eq(GameEvent.game, self.name), GTE(GameEvent.seq, start), LT(GameEvent.seq, end), fetch_links=True).sort(+GameEvent.seq):
+                    events.append(event)
+                if len(events) != end - start:
+                    log.warn(f"[Game: {self.name}] Expected {end - start} game events but loaded {len(events)}")
+                self.game_msgs[:0] = events
+                self.log_base = start
+                self.replay_chunks.clear()
+                self.log_loaded = True
+                wheel.add(self.evict_log_tick)
+        finally:
+            self.log_loading = None
+
+    def evict_log_tick(self):
+        ''' drop the in-memory log once the game has been empty for GAME_LOG_EVICT_SECS '''
+        if len(self.clients) > 0 or self.log_loading is not None:
+            self.empty_since = time.time()
+            return
+        if time.time() - self.empty_since < GAME_LOG_EVICT_SECS:
+            return
+        log.info(f"[Game: {self.name}] Evicting game log from memory ({len(self.game_msgs)} msgs)")
+        self.game_msgs = list()
+        self.log_base = self.model.n_game_msgs
+        self.log_loaded = False
+        self.snapshot = None
+        self.replay_chunks.clear()
+        return False
 
     def fix_players_order(self):
         players = dict()
@@ -1030,6 +1288,7 @@ class GameController(HasChats):
             logging.warn(f"I already have client: {client}")
             client.tell_warning("Tried to join room twice. This is probably a bug.")
             return
+        await self.ensure_log_loaded()
         self.on_client_entered(client)
         try:
             await self.run_client(client)
@@ -1041,10 +1300,22 @@ class GameController(HasChats):
     def tell_client_curr_scope(self, client: "Client"):
         client.set_scope(f"3|{self.name}")
 
-    async def game_info_loop(self, client: "Client"):
-        while client in self.clients and not client.disconnected:
-            client.write_message("GAME_INFO", self.to_inprog_game_info_json)
-            await asyncio.sleep(5.0)
+    def send_full_state(self, client: "Client"):
+        client.write_message("GAME_INFO", self.to_inprog_game_info_json)
+
+    def state_snapshot(self) -> dict:
+        # not pushed on every game msg (those carry their own seq); picked up by the info ticks
+        return self.to_inprog_game_info_json
+
+    def on_state_delta(self, delta: dict):
+        out = OutMsg(dict(type="GAME_DELTA", payload=delta))
+        for client in list(self.clients):
+            if client.state_deltas:
+                client.write_out(out)
+
+    def send_state(self, client: "Client"):
+        if client.state_deltas:
+            client.write_message("GAME_STATE", self.state.to_state_json)
 
     def send_game_info_full(self, client: "Client"):
         client.write_message("GAME_INFO_FULL", self.to_full_game_info_json)
@@ -1054,20 +1325,15 @@ class GameController(HasChats):
 
     def broadcast_gm_reset(self):
         msg = Message(type="GM_RESET", payload={})
-        asyncio.create_task(self.save_and_bcast_game_msg(msg))
+        self.broadcast_game_msg(msg)
 
     def broadcast_gm_player_joined(self, client):
         msg = Message(type="GM_PLAYER_JOINED", payload=client.user.safe_json)
-        asyncio.create_task(self.save_and_bcast_game_msg(msg))
+        self.broadcast_game_msg(msg)
 
     def broadcast_gm_player_left(self, client):
         msg = Message(type="GM_PLAYER_LEFT", payload=client.user.safe_json)
-        asyncio.create_task(self.save_and_bcast_game_msg(msg))
-
-    async def save_and_bcast_game_msg(self, msg: Message):
-        await msg.save()
         self.broadcast_game_msg(msg)
-        self.append_game_msg(msg)
 
 
     def on_client_handed_off(self, client: "Client"):
@@ -1079,7 +1345,8 @@ class GameController(HasChats):
     def on_client_entered(self, client: "Client"):
         self.tell_client_curr_scope(client)
         client.tell_info(f"Entered Game: {self.name}")
-        asyncio.create_task(self.game_info_loop(client))
+        self.start_info_ticks(client)
+        self.send_state(client)
         self.send_recent_chat(client)
         self.send_admin_mod_status(client)
         self.tell_player_list(client)
@@ -1096,9 +1363,14 @@ class GameController(HasChats):
         client.disconnect()
 
     def replay_game_so_far(self, client: "Client"):
-        client.write_message("GAME_REPLAY_START", {'n_msgs': len(self.model.game_msgs)})
-        for msg in self.model.game_msgs:
-            client.write_json(msg.safe_json)
+        snapshot = None if self.snapshot is None else self.snapshot.to_replay_json
+        client.write_message("GAME_REPLAY_START", {'n_msgs': len(self.game_msgs), 'snapshot': snapshot, 'chunked': client.replay_chunks})
+        if client.replay_chunks:
+            for out in self.replay_chunks.chunks(self.game_msgs):
+                client.write_out(out)
+        else:
+            for event in self.game_msgs:
+                client.write_out(event.to_out_msg)
         client.write_message("GAME_REPLAY_END", {})
 
     def assign_player_to_team(self, client: "Client"):
@@ -1121,36 +1393,82 @@ class GameController(HasChats):
     map_msg_types = {"CP_TIME", "FINAL_TIME", "ENTER_MAP", "LEAVE_MAP"}
     vote_msg_types = {"MAP_REROLL_VOTE_START", "MAP_REROLL_VOTE_SUBMIT", "MOD_MAP_REROLL"}
 
+    @classmethod
+    def is_game_log_type(cls, msg_type: str) -> bool:
+        ''' msgs that go in the game's log (GameEvent) rather than the Message collection '''
+        return msg_type.startswith("G_") or msg_type in cls.map_msg_types or msg_type in cls.vote_msg_types
+
     async def process_msg(self, client: "Client", msg: Message):
         if await self.process_admin_msg(client, msg) == "LEAVE": return "LEAVE"
         await self.process_chat_msg(client, msg)
         if msg.type == "LEAVE": return "LEAVE"
+        if msg.type == "STATE_RESYNC": return self.send_state(client)
+        if msg.type == "GAME_SNAPSHOT": return await self.on_game_snapshot(client, msg)
 
         # note: if streaming data is added (car pos or mouse pos), it should not be cached
 
-        is_game_msg = True
+        # G_ msgs are logged when broadcast; map/vote msgs are only logged
         if msg.type.startswith("G_"): await self.on_game_msg(client, msg)
-        elif msg.type in self.map_msg_types: await self.on_map_msg(client, msg)
-        elif msg.type in self.vote_msg_types: await self.on_map_vote_msg(client, msg)
-        else: is_game_msg = False
-        if msg.type == "CREATE_ROOM": await self.on_create_room(client, msg)
-        if is_game_msg:
+        elif msg.type in self.map_msg_types:
+            self.append_game_msg(msg)
+            await self.on_map_msg(client, msg)
+        elif msg.type in self.vote_msg_types:
             self.append_game_msg(msg)
+            await self.on_map_vote_msg(client, msg)
+        if msg.type == "CREATE_ROOM": await self.on_create_room(client, msg)
 
-    def append_game_msg(self, msg: Message):
+    def can_submit_snapshot(self, client: "Client") -> bool:
+        ''' admins, mods, and the game's leader (first player on the first team) '''
+        if self.is_admin(client.user) or self.is_mod(client.user): return True
+        teams = self.model.teams
+        return len(teams) > 0 and len(teams[0]) > 0 and teams[0][0] == client.user.uid
+
+    async def on_game_snapshot(self, client: "Client", msg: Message):
+        if not self.can_submit_snapshot(client):
+            return client.tell_warning("Permission denied (only the game leader or a mod can submit snapshots)")
+        seq, state = msg.payload.get('seq', None), msg.payload.get('state', None)
+        if not isinstance(seq, int) or seq < 0 or seq >= self.model.n_game_msgs:
+            return client.tell_error(f"Snapshot seq must be an int in [0, {self.model.n_game_msgs})")
+        if len(json_codec.dumps(state)) > MAX_SNAPSHOT_BYTES:
+            return client.tell_error(f"Snapshot state must be at most {MAX_SNAPSHOT_BYTES} bytes")
+        await self.ensure_log_loaded()
+        if self.snapshot is not None and seq <= self.snapshot.seq:
+            return  # stale
+        if self.snapshot is None:
+            self.snapshot = GameSnapshot(id=PydanticObjectId(), game=self.name, seq=seq, state=state, by=client.user.uid)
+        else:
+            self.snapshot.seq, self.snapshot.state, self.snapshot.by, self.snapshot.ts = seq, state, client.user.uid, time.time()
+        # the snapshot replaces everything up to seq, so we don't need to keep it
+        drop = self.replay_from - self.log_base
+        if drop > 0:
+            del self.game_msgs[:drop]
+            self.log_base += drop
+            self.replay_chunks.clear()
+        log.info(f"[Game: {self.name}] Snapshot at seq {seq} from {client.user.name}; {len(self.game_msgs)} msgs after it")
+        # saves are serialized and write the current snapshot, so the last one to finish is the newest
+        async with self.snapshot_lock:
+            await self.snapshot.save()
+
+    def append_game_msg(self, msg: Message) -> GameEvent:
+        ''' give the msg the next seq and append it to the log; only the counter is written to the GameSession '''
         log.info(f"[Game: {self.name} / {self.room.name}; msg.type={msg.type}")
-        self.model.game_msgs.append(msg)
+        seq = self.model.n_game_msgs
+        msg.payload['seq'] = seq
+        event = GameEvent.from_msg(self.name, seq, msg)
+        self.game_msgs.append(event)
+        game_event_writer.put(event)
+        self.model.n_game_msgs = seq + 1
         self.persist_model()
+        return event
 
     async def on_game_msg(self, client: "Client", msg: Message):
         # todo: visibility stuff
         self.broadcast_game_msg(msg)
 
     def broadcast_game_msg(self, msg: Message):
-        msg.payload['seq'] = len(self.model.game_msgs)
-        msg.save_via_task()
-        self.persist_model()
-        return self.broadcast_msg(msg)
+        event = self.append_game_msg(msg)
+        if len(self.clients) > 0:
+            self.broadcast_out(event.to_out_msg)
 
     # Overload previous room creation command and proxy stuff back to lobby.
     # Additionally, tell the other game clients
@@ -1158,7 +1476,7 @@ class GameController(HasChats):
         new_room = await self.room.lobby_inst.on_create_room(client, msg, handoff_at_end=False)
         msg = Message(type="GM_REMATCH_ROOM_CREATED", payload={'join_code': new_room.model.join_code, 'by': client.user.safe_json})
         client.write_message("REMATCH_ROOM_CREATED", msg.payload)
-        asyncio.create_task(self.save_and_bcast_game_msg(msg))
+        self.broadcast_game_msg(msg)
 
     async def on_map_msg(self, client: "Client", msg: Message):
         if msg.type == "LEAVE_MAP": return await self.on_map_leave(client, msg)
@@ -1199,73 +1517,72 @@ class GameController(HasChats):
 
 
 class Client:
-    reader: asyncio.StreamReader
-    writer: asyncio.StreamWriter
+    conn: FrameProtocol
+    outbound: OutboundQueue
+    wire: WireFormat = LEGACY_WIRE
+    ticks: dict[str, TickHandle]
+    # opted in (via CAPABILITIES) to *_STATE snapshots + *_DELTA updates instead of periodic full state
+    state_deltas: bool = False
+    # opted in (via CAPABILITIES) to game replays as GAME_REPLAY_CHUNK frames
+    replay_chunks: bool = False
     uid: str
     user: User
     lobby: "Lobby"
     disconnected: bool = False
 
-    def __init__(self, reader, writer) -> None:
-        self.reader = reader
-        self.writer = writer
+    def __init__(self, conn: FrameProtocol) -> None:
+        self.conn = conn
+        self.conn.on_activity = self.on_activity
+        self.outbound = OutboundQueue(conn, self.on_slow_consumer)
+        self.wire = LEGACY_WIRE
+        self.state_deltas = False
+        self.replay_chunks = False
         self.uid = os.urandom(16).hex()
         self.user = None
         self.disconnected = False
-        asyncio.create_task(self.ping_loop())
+        self.ticks = dict()
 
     def __hash__(self) -> int:
         return hash(self.uid)
 
     @property
     def client_ip(self) -> str:
-        return self.reader._transport.get_extra_info('peername')
+        return self.conn.transport.get_extra_info('peername')
 
-    async def ping_loop(self):
-        while self.user is None:
-            await asyncio.sleep(1.0)
-        while not self.disconnected:
-            if self.reader.at_eof():
-                return
-            self.send_server_info()
-            await asyncio.sleep(5.0)
+    def set_tick(self, name: str, fn: TickFn):
+        ''' run `fn` once per wheel period (replacing any previous tick with this name) '''
+        self.clear_tick(name)
+        self.ticks[name] = wheel.add(fn)
+
+    def clear_tick(self, name: str):
+        handle = self.ticks.pop(name, None)
+        if handle is not None:
+            wheel.remove(handle)
+
+    def ping_tick(self):
+        if self.disconnected or self.conn.at_eof:
+            return False
+        self.send_server_info()
 
     def send_server_info(self):
         self.write_json({"server": {"version": SERVER_VERSION, "n_clients": len(all_clients)}})
 
-    async def read_msg_inner(self) -> str:
-        try:
-            bs = None
-            reader_ex = self.reader.exception()
-            if reader_ex is None:
-                bs = await self.reader.read(2)
-            if (bs is None or len(bs) != 2):
-                logging.info(f"Client disconnected?? -- Maybe Reader Exception? e:{reader_ex}")
-                self.disconnect()
-                return None
-            msg_len, = struct.unpack_from('<H', bs)
-            # debug(f"Reading message of length: {msg_len}")
-            incoming = await self.reader.read(msg_len)
-            incoming = incoming.decode("UTF8")
-            # debug(f"Read message: {incoming}")
-            if self.user is not None:
-                self.user.last_seen = time.time()
-            if incoming == "END":
+    def on_activity(self):
+        # called once per batch of received frames, including PINGs
+        if self.user is not None:
+            self.user.on_activity()
+
+    async def read_msg_inner(self) -> bytes:
+        incoming = await self.conn.read_frame()
+        if incoming is None:
+            if self.conn.end_received:
                 logging.info(f"Client disconnecting: {self.client_ip}")
-                self.disconnect()
-                return None
-            if incoming == "PING": # skip pings
-                if self.user is not None:
-                    pass
-                    # logging.info(f"Got ping from user: {self.user.name} / {self.user.uid}")
-                return None
-            return incoming
-        except Exception as e:
-            self.tell_error(f"Unable to read message. {e}")
-            # warn(traceback.format_exception(e))
-        return None
+            else:
+                logging.info(f"Client disconnected (EOF): {self.client_ip}")
+            self.disconnect()
+        return incoming
 
-    async def read_msg(self) -> str:
+    async def read_msg(self) -> bytes:
         msg_str = await self.read_msg_inner()
         while msg_str is None and not self.disconnected:
             msg_str = await self.read_msg_inner()
@@ -1273,28 +1590,40 @@ class Client:
 
     async def read_json(self) -> dict:
         msg = await self.read_msg()
-        if msg is None or msg == "":
+        if msg is None or len(msg) == 0:
             return None
-        return json.loads(msg)
+        return json_codec.loads(msg)
 
     async def read_valid(self) -> Message:
         msg = await self.read_json()
         if msg is None: return None
         msg = self.validate_pl(msg)
-        if not msg.type.startswith("LOGIN"):
-            await msg.insert()
+        # game msgs, chat and snapshots are stored as GameEvent / ChatLine / GameSnapshot instead
+        if not msg.type.startswith("LOGIN") and msg.type not in EPHEMERAL_MSG_TYPES and msg.type not in ("SEND_CHAT", "GAME_SNAPSHOT") \
+                and not GameController.is_game_log_type(msg.type):
+            msg.persist()
         return msg
 
     def write_raw(self, msg: str):
-        if (self.writer.is_closing()): return
-        if (len(msg) >= 2**16):
-            raise MsgException(f"msg too long ({len(msg)})")
-        # debug(f"Write message ({len(msg)}): {msg}")
-        self.writer.write(struct.pack('<H', len(msg)))
-        self.writer.write(bytes(msg, "UTF8"))
+        return self.write_frame(encode_frame_str(msg, self.wire))
+
+    def write_frame(self, frame: bytes, key: str | None = None):
+        '''queue an already length-prefixed frame (see cgf.framing). `key` marks a snapshot that replaces older unsent copies.'''
+        self.outbound.put(frame, key)
+
+    def write_out(self, out: OutMsg):
+        try:
+            self.write_frame(out.frame_for(self.wire), out.key)
+        except MsgException as e:
+            logging.warning(f"[Client:{self.client_ip}] Dropping message of type {out.data.get('type', None)}: {e}")
 
     def write_json(self, data: dict):
-        return self.write_raw(json.dumps(data))
+        return self.write_out(OutMsg(data, snapshot_key(data)))
+
+    @property
+    def outbound_depth(self) -> int:
+        '''bytes waiting to be sent to this client'''
+        return self.outbound.depth
 
     def write_message(self, type: str, payload: Any, **kwargs):
         return self.write_json(dict(type=type, payload=payload, **kwargs))
@@ -1311,6 +1640,8 @@ class Client:
             rejoin_intent: str | None = None
             while not self.disconnected and self.user is None:
                 rejoin_intent = await self.init_client(rejoin_intent)
+            if self.user is not None:
+                self.set_tick("ping", self.ping_tick)
         except Exception as e:
             self.tell_error(f"Exception: {e}")
             logging.warn(f"[Client:{self.client_ip}] Got exception: {e}, \n{''.join(traceback.format_exception(e))}")
@@ -1331,15 +1662,15 @@ class Client:
                     lobby_name = scope_name
                 elif scope_type == 2:
                     room_name = scope_name
-                    _r = await Room.find_one(Room.name == scope_name)
+                    _r = registry.rooms_by_name.get(scope_name, None)
                     if _r is not None:
-                        lobby_name = _r.lobby
+                        lobby_name = _r.lobby_inst.name
                 elif scope_type == 3:
                     game_name = scope_name
-                    _g = await GameSession.find_one(GameSession.name == scope_name)
+                    _g = registry.games_by_name.get(scope_name, None)
                     if _g is not None:
-                        lobby_name = _g.lobby
-                        room_name = _g.room
+                        lobby_name = _g.room.lobby_inst.name
+                        room_name = _g.room.name
                 else:
                     log.warning(f"Unknown scope type: {scope_type} from last_scope: {self.user.last_scope}")
             # only rejoin if we want to rejoin to that same game
@@ -1351,11 +1682,14 @@ class Client:
     async def init_client(self, rejoin_intent: str | None = None):
         # register_or_login
         msg = await self.read_valid()
+        while msg is not None and msg.type in ("REJOIN_INTENT", "CAPABILITIES"):
+            if msg.type == "REJOIN_INTENT":
+                rejoin_intent = msg.payload.get('lobby', None)
+            else:
+                self.on_capabilities(msg)
+            msg = await self.read_valid()
         if msg is None:
             return
-        if msg.type == "REJOIN_INTENT":
-            rejoin_intent = msg.payload.get('lobby', None)
-            msg = await self.read_valid()
         user = None
         checked_for_user = False
         if msg.type == "LOGIN_TOKEN":
@@ -1366,16 +1700,15 @@ class Client:
                 user = get_user(uid_from_wsid(tokenInfo.account_id))
                 if user is None:
                     user = await register_authed_user(tokenInfo)
-                # update this in case the user updated their account name
-                user.name = tokenInfo.display_name
                 if user is not None:
-                    await user.set({User.last_seen: time.time(), User.n_logins: user.n_logins + 1, User.name: tokenInfo.display_name})
+                    # update the name in case the user changed their account name; written in the background
+                    user.record_login(tokenInfo.display_name)
                     self.write_json(dict(type="LOGGED_IN", uid=user.uid, account_id=tokenInfo.account_id, display_name=tokenInfo.display_name))
         if ENABLE_LEGACY_AUTH and msg.type == "LOGIN":
             user = authenticate_user(msg['uid'], msg['username'], msg['secret'])
             checked_for_user = True
             if user is not None:
-                await user.set({User.last_seen: time.time(), User.n_logins: user.n_logins + 1})
+                user.record_login()
                 self.write_json(dict(type="LOGGED_IN"))
         if ENABLE_LEGACY_AUTH and msg.type == "REGISTER":
             user = await register_user(msg['username'], msg['wsid'])
@@ -1393,6 +1726,16 @@ class Client:
         self.user = user
         return rejoin_intent
 
+    def on_capabilities(self, msg: Message):
+        wire = WireFormat.from_capabilities(msg.payload)
+        self.state_deltas = msg.payload.get('state', None) == "delta"
+        self.replay_chunks = msg.payload.get('replay', None) == "chunks"
+        # the ack goes out in the old format; everything after it uses the new one
+        self.write_message("CAPABILITIES_ACK", dict(**wire.to_json, state="delta" if self.state_deltas else "full",
+            replay="chunks" if self.replay_chunks else "msgs"))
+        self.wire = wire
+        logging.info(f"[Client:{self.client_ip}] Negotiated wire format: {wire}")
+
     def tell_error(self, msg: str):
         logging.warn(f"[Client:{self.client_ip}] Sending error to client: {msg}")
         self.write_json({"error": msg})
@@ -1421,17 +1764,25 @@ class Client:
             return None
         return Message(type=pl['type'], payload=pl['payload'], visibility=pl['visibility'], user=self.user)
 
+    def on_slow_consumer(self):
+        logging.warning(f"[Client:{self.client_ip}] Disconnecting slow consumer")
+        self.disconnect()
+
     def disconnect(self):
         if self.disconnected: return
         try:
-            self.write_raw("END")
+            self.outbound.close()
+            if not self.conn.is_closing():
+                self.conn.write(encode_frame_str("END", self.wire))
         except:
             pass
-        transport: asyncio.Transport = self.reader._transport
-        self.writer.write_eof()
-        self.reader.feed_eof()
-        transport.close()
+        self.conn.close()
+        self.conn.feed_eof()
+        for name in list(self.ticks):
+            self.clear_tick(name)
         self.disconnected = True
+        if self.user is not None:
+            self.user.persist_last_seen()
         self.lobby.on_client_left(self)
 
 
@@ -1448,7 +1799,8 @@ class Lobby(HasChats):
         if (model.name in all_lobbies):
             raise Exception("Lobby created more than once but exists in dict already")
         all_lobbies[model.name] = self
-        self.loaded_rooms = False
+        self.loaded_rooms = asyncio.Event()
+        self.state = VersionedState(self.state_snapshot, self.on_state_delta)
         self.load_rooms_task = asyncio.create_task(self.load_rooms())
         self.clear_old_rooms_task = asyncio.create_task(self.clear_old_rooms())
 
@@ -1477,8 +1829,8 @@ class Lobby(HasChats):
         return self.model.is_public
 
     async def initialized(self):
-        while not self.loaded_chat or not self.load_rooms:
-            await asyncio.sleep(0.05)
+        await self.loaded_chat.wait()
+        await self.loaded_rooms.wait()
 
     async def load_rooms(self):
         with timeit_context("Load Rooms"):
@@ -1486,7 +1838,8 @@ class Lobby(HasChats):
             async for room_model in rooms:
                 room = RoomController(room_model, lobby_inst=self)
                 self.rooms[room.name] = room
-            self.loaded_rooms = True
+                registry.register_room(room)
+            self.loaded_rooms.set()
 
     async def clear_old_rooms(self):
         await asyncio.sleep(20)
@@ -1509,11 +1862,14 @@ class Lobby(HasChats):
         if not room.model.is_retired:
             room.model.is_open = False
             room.model.is_retired = True
+            room.teams_changed.set()
             room.persist_model()
             if room.model.use_club_room and room.model.cr_activity_id > 0:
                 asyncio.create_task(delete_club_room(room.model.cr_activity_id))
         if room.name in self.rooms:
             self.rooms.pop(room.name)
+        registry.unregister_room(room)
+        self.state.changed()
         self.broadcast_msg(Message(type="ROOM_RETIRED", payload=dict(name=room.name)))
 
     @property
@@ -1555,17 +1911,33 @@ class Lobby(HasChats):
     def tell_client_curr_scope(self, client: Client):
         client.set_scope(f"{0 if self.parent_lobby is None else 1}|{self.name}")
 
-    async def lobby_info_loop(self, client: Client):
-        while client in self.clients and not client.disconnected:
-            self.send_lobby_info(client)
-            await asyncio.sleep(5.0)
+    def send_full_state(self, client: Client):
+        self.send_lobby_info(client)
 
     def send_lobby_info(self, client: Client):
         client.write_message("LOBBY_INFO", self.json_info)
 
+    def state_snapshot(self) -> dict:
+        # rooms get their own keys so a delta only carries the rooms that changed
+        info = self.json_info
+        ret = {f"rooms/{r['name']}": r for r in info.pop('rooms')}
+        ret.update(info)
+        return ret
+
+    def on_state_delta(self, delta: dict):
+        out = OutMsg(dict(type="LOBBY_DELTA", payload=delta))
+        for client in list(self.clients):
+            if client.state_deltas:
+                client.write_out(out)
+
+    def send_state(self, client: Client):
+        if client.state_deltas:
+            client.write_message("LOBBY_STATE", self.state.to_state_json)
+
     def on_client_handed_off(self, client: Client):
         if client in self.clients:
             self.clients.remove(client)
+        self.state.changed()
         self.broadcast_player_left(client)
 
     def on_client_entered(self, client: Client):
@@ -1574,19 +1946,22 @@ class Lobby(HasChats):
             self.persist_model()
         self.tell_client_curr_scope(client)
         client.tell_info(f"Entered Lobby: {self.name}")
-        asyncio.create_task(self.lobby_info_loop(client))
+        self.start_info_ticks(client)
+        self.send_state(client)
         self.send_lobby_info(client)
         self.send_lobbies_list(client)
         self.send_admin_mod_status(client)
         self.send_recent_chat(client)
         self.tell_player_list(client)
         self.clients.add(client)
+        self.state.changed()
         self.broadcast_player_joined(client)
 
     def on_client_left(self, client: Client):
         client.disconnect()
         if client in self.clients:
             self.clients.remove(client)
+            self.state.changed()
         if client in all_clients:
             all_clients.remove(client)
 
@@ -1630,6 +2005,7 @@ class Lobby(HasChats):
         elif msg.type == "CREATE_ROOM": await self.on_create_room(client, msg)
         elif msg.type == "JOIN_ROOM": await self.on_join_room(client, msg)
         elif msg.type == "JOIN_CODE": await self.on_join_code(client, msg)
+        elif msg.type == "STATE_RESYNC": self.send_state(client)
 
     async def on_msg_template(self, client: Client, msg: Message):
         pass
@@ -1714,7 +2090,10 @@ class Lobby(HasChats):
         )
         # note: will throw if name collision
         await room.model.save()
+        # only once it's saved, so a failed save can't shadow an existing room
+        registry.register_room(room)
         self.rooms[room.name] = room
+        self.state.changed()
         self.broadcast_msg(Message(type="NEW_ROOM", payload=room.to_room_info_json))
         client.write_message("ROOM_INFO", room.to_created_room_json)
         if handoff_at_end:
@@ -1723,6 +2102,7 @@ class Lobby(HasChats):
             return room
 
     def update_room_status(self, room: RoomController):
+        self.state.changed()
         self.broadcast_msg(Message(type="ROOM_UPDATE", payload=dict(name=room.name, n_players=len(room.clients))))
 
     async def on_join_room(self, client: Client, msg: Message):
@@ -1735,9 +2115,8 @@ class Lobby(HasChats):
 
     async def on_join_code(self, client: Client, msg: Message):
         code: str = msg.payload.get('code', None)
-        room_model = None if code is None else await Room.find_one({'join_code': code.upper()})
-        room = None if room_model is None else self.rooms.get(room_model.name, None)
-        if room is None:
+        room = registry.room_by_join_code(code) if isinstance(code, str) else None
+        if room is None or room.lobby_inst is not self:
             client.tell_warning(f"Cannot find room with join code: {code}")
         else:
             await self.handoff_to_room(client, room)
@@ -1745,6 +2124,20 @@ class Lobby(HasChats):
 
 
 
+def outbound_queue_depths() -> dict[str, int]:
+    '''bytes queued per connected client, keyed by client uid'''
+    return {c.uid: c.outbound_depth for c in all_clients}
+
+
+async def log_outbound_stats_loop(interval: float = 60 * 10):
+    while True:
+        await asyncio.sleep(interval)
+        depths = outbound_queue_depths()
+        if len(depths) == 0: continue
+        deepest = sorted(depths.items(), key=lambda kv: kv[1], reverse=True)[:5]
+        logging.info(f"Outbound queues: {sum(depths.values())} bytes queued for {len(depths)} clients; deepest: {deepest}")
+
+
 async def populate_all_lobbies():
     async for lobby_model in LobbyModel.find_all(fetch_links=True):
         Lobby(lobby_model)
@@ -1775,19 +2168,3 @@ async def get_named_lobby(name: str) -> Optional[Lobby]:
     model = await LobbyModel.find_one({'name': name}, fetch_links=True)
     if model is not None:
         return Lobby(model)
-
-class ChatMessages(Document):
-    msgs: list[Link[Message]]
-    lobby: Optional[Indexed(str, name="lobby_ix")] = None
-    room: Optional[Indexed(str, name="room_ix")] = None
-    game: Optional[Indexed(str, name="game_ix")] = None
-
-    class Settings:
-        use_state_management = True
-
-    def append(self, msg: Message):
-        self.msgs.append(msg)
-        self.save_changes_in_task()
-
-    def save_changes_in_task(self):
-        asyncio.create_task(self.save_changes())
@@ -91,18 +91,18 @@ async def get_token_for_audience(ubi: UbiAuthResp, audience: str):
 
 NadeoCoreToken: NadeoToken | None = None
 NadeoLiveToken: NadeoToken | None = None
+# set once we have both tokens
+nadeo_tokens_ready = asyncio.Event()
 
 
 async def await_nadeo_services_initialized(raise_on_timeout=False):
-    count = 0.0
-    while NadeoCoreToken is None or NadeoLiveToken is None:
-        await asyncio.sleep(.05)
-        count += 0.05
-        if count > 20.0:
-            logging.warn(f"nadeo services not initialized after 20 seconds!")
-            if raise_on_timeout:
-                raise Exception("nadeo services not initialized after 20 seconds!")
-            return
+    if nadeo_tokens_ready.is_set(): return
+    try:
+        await asyncio.wait_for(nadeo_tokens_ready.wait(), 20.0)
+    except asyncio.TimeoutError:
+        logging.warn(f"nadeo services not initialized after 20 seconds!")
+        if raise_on_timeout:
+            raise Exception("nadeo services not initialized after 20 seconds!")
 
 
 def all_tokens() -> list[NadeoToken | None]:
@@ -129,6 +129,9 @@ async def reacquire_all_tokens():
         if LOCAL_DEV_MODE:
             logging.warn(f"Got live token: {NadeoLiveToken.accessToken}")
 
+    if NadeoCoreToken is not None and NadeoLiveToken is not None:
+        nadeo_tokens_ready.set()
+
 async def run_nadeo_services_auth():
     await reacquire_all_tokens()
     while True:
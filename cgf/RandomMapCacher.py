@@ -6,7 +6,10 @@ import time
 import botocore
 
 import aiohttp
-from beanie.operators import In, Eq
+from beanie.operators import In
+from bson import ObjectId
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
 from cgf.NadeoApi import await_nadeo_services_initialized, get_totd_maps
 
 from cgf.consts import LOCAL_DEV_MODE, SERVER_VERSION, SHUTDOWN, SHUTDOWN_EVT
@@ -14,8 +17,11 @@ from cgf.models.MapPack import MapPack
 from cgf.models.RandomMapQueue import RandomMapQueue
 from cgf.utils import chunk
 from cgf.http import get_session
-from cgf.models.Map import LONG_MAP_SECS, Map, MapJustID, difficulty_to_int
+from cgf.models.Map import LONG_MAP_SECS, Map, MapEligibility, MapJustID, difficulty_to_int, length_secs_to_enum
+from cgf.map_index import map_index
 from cgf.db import s3, s3_bucket_name, s3_client
+from cgf.s3_manifest import manifest
+from cgf.work_queue import PriorityWorkQueue, RateLimiter
 
 fresh_random_maps: list[Map] = list()
 maps_to_cache: list[Map] = list()
@@ -23,9 +29,33 @@ known_maps: set[int] = set()
 cached_maps: set[int] = set()
 totd_tids: set[int] = set()
 
-initialized_totds = False
-
-MAINTAIN_N_MAPS = 200 if not LOCAL_DEV_MODE else 20  #200
+initialized_totds = asyncio.Event()
+
+# generic pool; only rooms that accept any map take from it directly, and it's drained into the filter pools
+MAINTAIN_N_MAPS = 50 if not LOCAL_DEV_MODE else 10
+
+# map cache queue lanes; lower goes first
+PRIORITY_ROOM = 0  # maps a room just picked
+PRIORITY_NEW = 1  # maps we just learned about
+PRIORITY_CRAWL = 2  # everything else, slowly
+CACHE_WORKERS = 6
+TMX_DOWNLOADS_PER_SEC = 5.0
+# crawl TrackIDs queued at once
+CRAWL_BACKLOG = 50
+tmx_download_limiter = RateLimiter(TMX_DOWNLOADS_PER_SEC)
+
+# (min_secs, max_secs, max_difficulty), as passed to get_some_maps
+MapFilter = tuple[int, int, int]
+ANY_MAP_FILTER: MapFilter = (15, LONG_MAP_SECS, 5)
+# pre-warmed pools for the filters rooms ask for most
+filter_pools: dict[MapFilter, list[Map]] = dict()
+# maps requested per filter, decaying with FILTER_DEMAND_HALF_LIFE
+filter_demand: dict[MapFilter, float] = dict()
+MAX_FILTER_POOLS = 8
+FILTER_POOL_N_MAPS = 30 if not LOCAL_DEV_MODE else 5
+FILTER_DEMAND_HALF_LIFE = 60 * 60 * 6
+# filters with less demand than this don't get a pool
+MIN_FILTER_DEMAND = 1.0
 
 async def load_random_map_queue():
     return await RandomMapQueue.find_one(RandomMapQueue.name == "main")
@@ -44,6 +74,39 @@ async def init_fresh_maps_from_db():
         fresh_random_maps = await Map.find(In(Map.TrackID, cached_random_maps.tracks)).to_list()
         random.shuffle(fresh_random_maps)
     logging.info(f"fresh random maps loaded from db: {len(fresh_random_maps)}")
+    queues = await RandomMapQueue.find(RandomMapQueue.name != "main").to_list()
+    for q in queues:
+        map_filter = filter_from_queue_name(q.name)
+        if map_filter is None: continue
+        filter_pools[map_filter] = await Map.find(In(Map.TrackID, q.tracks)).to_list()
+        # keep it around until rooms show whether it's still wanted
+        filter_demand[map_filter] = FILTER_POOL_N_MAPS
+    if len(filter_pools) > 0:
+        logging.info(f"filtered map pools loaded from db: { {k: len(v) for k, v in filter_pools.items()} }")
+
+def queue_name_for_filter(map_filter: MapFilter) -> str:
+    return "filter:" + ','.join(map(str, map_filter))
+
+def filter_from_queue_name(name: str) -> MapFilter | None:
+    if not name.startswith("filter:"): return None
+    try:
+        min_secs, max_secs, max_difficulty = map(int, name[7:].split(','))
+        return (min_secs, max_secs, max_difficulty)
+    except ValueError:
+        return None
+
+async def sync_filter_pool_queues():
+    existing = {q.name: q for q in await RandomMapQueue.find(RandomMapQueue.name != "main").to_list()}
+    for map_filter, pool in list(filter_pools.items()):
+        name = queue_name_for_filter(map_filter)
+        q = existing.pop(name, None)
+        if q is None:
+            q = RandomMapQueue(name=name, tracks=list())
+        q.tracks = [m.TrackID for m in pool]
+        await q.save()
+    for q in existing.values():
+        if q.name.startswith("filter:"):
+            await q.delete()
 
 class MapPackNotFound(Exception):
     def __init__(self, _id: int, status_code: int | None, message: str | None, *args: object) -> None:
@@ -59,6 +122,11 @@ async def init_known_maps():
     _maps = await Map.find_all(projection_model=MapJustID).to_list()
     known_maps.update([m.TrackID for m in _maps])
     logging.info(f"Known maps: {len(known_maps)}")
+    if manifest.exists():
+        cached_maps.update(manifest.load())
+    async for m in Map.find(*rm_query_args(), projection_model=MapEligibility):
+        map_index.update(m)
+    logging.info(f"Indexed random-eligible maps: {len(map_index)}")
     asyncio.create_task(ensure_known_maps_have_difficulty_int())
     if not LOCAL_DEV_MODE:
         asyncio.create_task(ensure_known_maps_cached())
@@ -70,6 +138,7 @@ async def ensure_known_maps_have_difficulty_int():
         if SHUTDOWN: break
         m.DifficultyInt = difficulty_to_int(m.DifficultyName)
         await m.save()
+        map_index.update(m)
         # logging.info(f"Set map difficulty: {m.TrackID}: {m.DifficultyName} = {m.DifficultyInt}")
     logging.info(f"Set DifficultyInt on {len(maps)} maps")
 
@@ -104,73 +173,72 @@ async def update_maps_from_tmx(tids_or_uids: list[int | str]):
 
 async def ensure_known_maps_cached():
     log_s3_progress = True
-    first_run = True
     while not SHUTDOWN:
         _known_maps = set(known_maps)
-        if first_run:
-            cached_maps.update(await asyncio.get_event_loop().run_in_executor(None, _get_bucket_keys_outer, log_s3_progress))
+        max_map_id = 81192 if len(_known_maps) == 0 else max(_known_maps)
+        await reconcile_cache_manifest(max_map_id, log_s3_progress)
         log_s3_progress = False  # don't log again on following loops
         uncached = _known_maps - cached_maps
         logging.info(f"Getting {len(uncached)} uncached but known maps")
-        for i, track_id in enumerate(uncached):
-            await asyncio.sleep(0.300) # sleep 300 ms between checks
-            logging.info(f"Getting uncached: {track_id}")
-            asyncio.create_task(cache_map(track_id))
-        max_map_id = 81192 if len(_known_maps) == 0 else max(_known_maps)
-        other_map_ids = list(set(range(0, max_map_id)) - cached_maps)
-        # slowly get all the other maps proactively
+        cache_maps(list(uncached))
+        other_map_ids = list(set(range(0, max_map_id)) - cached_maps - uncached)
+        # slowly get all the other maps proactively, without getting ahead of the workers
         logging.info(f"Caching {len(other_map_ids)} uncached maps")
-        for tids in chunk(other_map_ids, 3):
-            await asyncio.wait(map(cache_map, tids))
+        for tid in other_map_ids:
+            while len(cache_queue) >= CRAWL_BACKLOG and not SHUTDOWN:
+                await asyncio.sleep(1.0)
+            if SHUTDOWN: break
+            cache_queue.put(tid, PRIORITY_CRAWL)
+        logging.info(f"Map cache queue: {cache_queue.stats_report()}")
         waiting_secs = 60 * 60  # an hour
         for _ in range(waiting_secs * 10):
             await asyncio.sleep(0.1)
             if SHUTDOWN: break
         # at end we want to get any new maps so we cache them
         await add_latest_maps()
-        first_run = False
 
-def _get_bucket_keys_outer(log_s3_progress = True) -> set[int]:
-    try:
-        return _get_bucket_keys()
-    except Exception as e:
-        logging.warn(f"Exception getting bucket keys: {e}")
-        logging.warn(f"Sleeping and trying to get bucket keys again")
-    return _get_bucket_keys_outer(log_s3_progress)
-
-
-def _get_bucket_keys(log_s3_progress = True) -> set[int]:
-    cached_maps = set()
-    avg_size = 0
-    nb_in_avg = 0
-    bucket = s3.Bucket(s3_bucket_name)
-    for k in bucket.objects.all():
-        if SHUTDOWN_EVT.is_set(): break
+async def reconcile_cache_manifest(up_to: int, log_s3_progress = True):
+    ''' add maps up to TrackID `up_to` that are in the bucket but not the manifest; lists the whole bucket only the first time '''
+    full_listing = manifest.listed_up_to is None
+    while True:
         try:
-            cached_maps.add(int(k.key.split('.Map.Gbx')[0]))
-            avg_size = (avg_size * nb_in_avg + k.size) / (nb_in_avg + 1)
-            nb_in_avg += 1
+            track_ids, listed_up_to = await asyncio.get_event_loop().run_in_executor(
+                None, manifest.list_new_keys_blocking, s3_client, s3_bucket_name, up_to, SHUTDOWN_EVT.is_set, log_s3_progress and full_listing)
+            break
         except Exception as e:
-            print(f"Got exception getting key: {e}")
-        if log_s3_progress and len(cached_maps) % 1000 == 0:
-            logging.info(f"Loading cached maps... {len(cached_maps)} / ??? | avg size: {avg_size / 1024:.1f} kb")
-        # does not work when running in executor
-        # if not asyncio.get_event_loop().is_running():
-        #     logging.info(f"Breaking get bucket keys b/c event looped stopped")
-        #     break
-    logging.info(f"Loaded cached maps: {len(cached_maps)} total | avg size: {avg_size / 1024:.1f} kb")
-    return cached_maps
-
-async def cache_map(track_id: int, force = False, delay_ms=0):
-    if delay_ms > 0:
-        await asyncio.sleep(delay_ms / 1000)
+            logging.warn(f"Exception listing bucket keys: {e}")
+            logging.warn(f"Sleeping and trying to list bucket keys again")
+            await asyncio.sleep(10)
+    new_tids = track_ids - cached_maps
+    cached_maps.update(track_ids)
+    if full_listing:
+        await manifest.rewrite(cached_maps, listed_up_to)
+    else:
+        await manifest.record_listing(new_tids, listed_up_to)
+    logging.info(f"S3 cache manifest reconciled: {len(new_tids)} new maps, {len(cached_maps)} total, listed up to {listed_up_to}")
+
+def mark_map_cached(track_id: int):
+    if track_id in cached_maps: return
+    cached_maps.add(track_id)
+    manifest.record(track_id)
+
+def cache_maps(track_ids: list[int], priority: int = PRIORITY_NEW):
+    ''' queue a batch of maps for the cache; ones we know are cached are skipped without asking s3 '''
+    cache_queue.put_many((t for t in track_ids if t not in cached_maps), priority)
+
+async def cache_map(track_id: int, force = False):
     map_cached = await is_map_cached(track_id)
     if force or not map_cached:
         await _download_and_cache_map(track_id)
 
+cache_queue = PriorityWorkQueue("MapCache", cache_map, n_workers=CACHE_WORKERS)
+
 async def is_map_cached(track_id: int):
     if track_id in cached_maps: return True
-    return await asyncio.get_event_loop().run_in_executor(None, is_map_cached_blocking, track_id)
+    if await asyncio.get_event_loop().run_in_executor(None, is_map_cached_blocking, track_id):
+        mark_map_cached(track_id)
+        return True
+    return False
 
 def is_map_cached_blocking(track_id: int):
     map_file = f"{track_id}.Map.Gbx"
@@ -189,36 +257,34 @@ async def add_map_to_db_via_id(track_id: int):
         known_maps.add(track_id)
 
 
-async def _download_and_cache_map(track_id: int, retry_times=10):
+async def _download_and_cache_map(track_id: int):
+    ''' raises on errors worth retrying (cache_queue retries with backoff) '''
     map_file = f"{track_id}.Map.Gbx"
+    await tmx_download_limiter.acquire()
     logging.info(f"Caching map: {map_file}")
-    # does not exist
-    try:
-        async with get_session() as session:
-            async with session.get(f"https://trackmania.exchange/maps/download/{track_id}") as resp:
-                if resp.status == 200:
-                    map_bs = await resp.content.read()
-                    await asyncio.get_event_loop().run_in_executor(
-                        None,
-                        lambda: s3.Object(s3_bucket_name, map_file).put(
-                            ACL='public-read',
-                            Body=map_bs
-                        )
+    async with get_session() as session:
+        async with session.get(f"https://trackmania.exchange/maps/download/{track_id}") as resp:
+            if resp.status == 200:
+                map_bs = await resp.content.read()
+                await asyncio.get_event_loop().run_in_executor(
+                    None,
+                    lambda: s3.Object(s3_bucket_name, map_file).put(
+                        ACL='public-read',
+                        Body=map_bs
                     )
-                    logging.info(f"Uploaded map to s3 cache: {map_file}")
-                    cached_maps.add(track_id)
-                else:
-                    logging.warn(f"Could not get map {track_id}, code: {resp.status}")
-    except Exception as e:
-        if retry_times <= 0:
-            raise e
-        logging.warn(f"Error caching map. Waiting 10s and retrying up to {retry_times} more times")
-        await asyncio.sleep(10)
-        await _download_and_cache_map(track_id, retry_times=retry_times - 1)
+                )
+                logging.info(f"Uploaded map to s3 cache: {map_file}")
+                mark_map_cached(track_id)
+            elif resp.status == 429 or resp.status >= 500:
+                raise Exception(f"TMX returned {resp.status}")
+            else:
+                # missing/deleted maps; the crawl hits a lot of these
+                logging.warn(f"Could not get map {track_id}, code: {resp.status}")
 
 
 async def maintain_random_maps():
     asyncio.create_task(maintain_random_maps_slow())
+    asyncio.create_task(maintain_filter_pools())
     while True:
         if len(fresh_random_maps) < MAINTAIN_N_MAPS:
             await add_more_random_maps(10)
@@ -231,7 +297,7 @@ lastFRM = 0
 async def maintain_random_maps_slow():
     global lastFRM
     while True:
-        if len(fresh_random_maps) < MAINTAIN_N_MAPS * 10:
+        if len(fresh_random_maps) < MAINTAIN_N_MAPS * 2:
             await add_more_random_maps(1)
             currFRM = len(fresh_random_maps)
             if currFRM % 10 == 0:
@@ -239,12 +305,88 @@ async def maintain_random_maps_slow():
                 await sync_random_map_queue()
         await asyncio.sleep(2)
 
+def map_matches_filter(m: Map, map_filter: MapFilter) -> bool:
+    min_secs, max_secs, max_difficulty = map_filter
+    return min_secs <= m.LengthSecs <= max_secs and m.DifficultyInt is not None and m.DifficultyInt <= max_difficulty
+
+def note_filter_demand(map_filter: MapFilter, n: int):
+    if map_filter == ANY_MAP_FILTER: return
+    filter_demand[map_filter] = filter_demand.get(map_filter, 0.0) + n
+
+def popular_filters() -> list[MapFilter]:
+    ranked = sorted(filter_demand.items(), key=lambda kv: kv[1], reverse=True)
+    return [f for f, demand in ranked[:MAX_FILTER_POOLS] if demand >= MIN_FILTER_DEMAND]
+
+def tmx_params_for_filter(map_filter: MapFilter) -> dict[str, str]:
+    '''
+    mapsearch2 takes one length bound (`length` is a LengthEnum, `lengthop` 0: exactly, 1: shorter than, 2: longer than)
+    and one difficulty, so the tighter length bound is used and results are checked against the full filter on arrival.
+    '''
+    min_secs, max_secs, max_difficulty = map_filter
+    min_enum, max_enum = length_secs_to_enum(min_secs), length_secs_to_enum(max_secs)
+    params = dict()
+    if min_enum == max_enum:
+        params.update(length=str(min_enum), lengthop='0')
+    elif max_secs < LONG_MAP_SECS:
+        params.update(length=str(max_enum + 1), lengthop='1')
+    elif min_secs > 15:
+        params.update(length=str(min_enum - 1), lengthop='2')
+    if max_difficulty < 5:
+        params['difficulty'] = str(random.randint(0, max_difficulty))
+    return params
+
+async def maintain_filter_pools():
+    decay = 0.5 ** (1.0 / FILTER_DEMAND_HALF_LIFE)
+    last_decay = time.time()
+    last_sync = time.time()
+    while True:
+        now = time.time()
+        factor = decay ** (now - last_decay)
+        last_decay = now
+        for map_filter in list(filter_demand.keys()):
+            filter_demand[map_filter] *= factor
+            if filter_demand[map_filter] < MIN_FILTER_DEMAND / 100 and map_filter not in filter_pools:
+                del filter_demand[map_filter]
+        popular = popular_filters()
+        for map_filter in list(filter_pools.keys()):
+            if map_filter not in popular:
+                # any filtered map is fine for the generic pool
+                fresh_random_maps.extend(filter_pools.pop(map_filter))
+        to_fill = [f for f in popular if len(filter_pools.get(f, [])) < FILTER_POOL_N_MAPS]
+        fill_filter_pools_from_generic(to_fill)
+        to_fill = [f for f in to_fill if len(filter_pools.get(f, [])) < FILTER_POOL_N_MAPS]
+        if len(to_fill) > 0:
+            await asyncio.wait([asyncio.create_task(add_more_filtered_maps(f, min(5, FILTER_POOL_N_MAPS - len(filter_pools.get(f, []))))) for f in to_fill])
+        if now - last_sync > 60:
+            last_sync = now
+            await sync_filter_pool_queues()
+        await asyncio.sleep(0.5 if len(to_fill) > 0 else 2.0)
+
+def fill_filter_pools_from_generic(map_filters: list[MapFilter]):
+    ''' move maps from the generic pool into filter pools (in `map_filters` order) that aren't full '''
+    if len(map_filters) == 0: return
+    keep = list()
+    for m in fresh_random_maps:
+        dest = next((f for f in map_filters if map_matches_filter(m, f) and len(filter_pools.get(f, [])) < FILTER_POOL_N_MAPS), None)
+        if dest is None:
+            keep.append(m)
+        else:
+            filter_pools.setdefault(dest, list()).append(m)
+    fresh_random_maps[:] = keep
+
+async def add_more_filtered_maps(map_filter: MapFilter, n: int):
+    if n <= 0: return
+    try:
+        await asyncio.wait([asyncio.create_task(_add_a_random_map(delay=i * 0.1, map_filter=map_filter)) for i in range(n)])
+    except Exception as e:
+        logging.warn(f"Exception getting random maps for filter {map_filter} (passing over): {e}")
+
 async def add_more_random_maps(n: int):
     if (n > 100): raise Exception(f"too many maps requested: {n}")
     if (n > 1): logging.info(f"Fetching {n} random maps")
     if n <= 0: return
     try:
-        await asyncio.wait([_add_a_random_map(delay = i * 0.1) for i in range(n)])
+        await asyncio.wait([asyncio.create_task(_add_a_random_map(delay = i * 0.1)) for i in range(n)])
         if (n > 1): logging.info(f"Fetched {n} random maps")
     except Exception as e:
         logging.warn(f"Exception getting random maps (passing over): {e}")
@@ -258,8 +400,11 @@ def mk_url_params(params: dict[str, str], prefix_ampersand=False):
     '''will only prefix ampersand if params is not empty'''
     return ('&' if prefix_ampersand and len(params) > 0 else '') + '&'.join([f"{k}={v}" for k,v in params.items()])
 
-async def _add_a_random_map(delay = 0, extra_params=None):
+async def _add_a_random_map(delay = 0, extra_params=None, map_filter: MapFilter | None = None):
+    ''' with `map_filter`, the map goes to that filter's pool (or the generic pool if it doesn't match) '''
     params = dict(**RANDOM_MAP_TMX_PARAMS)
+    if map_filter is not None:
+        params.update(tmx_params_for_filter(map_filter))
     if extra_params is not None:
         params.update(extra_params)
     params_str = mk_url_params(params, True)
@@ -268,14 +413,24 @@ async def _add_a_random_map(delay = 0, extra_params=None):
     async with get_session() as session:
         try:
             async with session.get(f"https://trackmania.exchange/mapsearch2/search?api=on&random=1{params_str}", timeout=10.0) as resp:
-                if resp.status == 200:
+                if resp.status == 200 and map_filter is not None:
+                    for m in await _add_maps_from_json(await resp.json(), False):
+                        if map_matches_filter(m, map_filter):
+                            filter_pools.setdefault(map_filter, list()).append(m)
+                        else:
+                            fresh_random_maps.append(m)
+                elif map_filter is not None:
+                    # the index covers filtered requests when TMX is down
+                    logging.warning(f"Could not get random map for filter {map_filter}: {resp.status} code.")
+                elif resp.status == 200:
                     await _add_maps_from_json(await resp.json())
                 else:
                     logging.warning(f"Could not get random map: {resp.status} code. TMX might be down. Adding some random maps from the DB.")
                     await add_maps_from_db()
         except asyncio.TimeoutError as e:
             logging.warning(f"TMX timeout for random maps")
-            await add_maps_from_db()
+            if map_filter is None:
+                await add_maps_from_db()
 
 
 async def add_maps_from_db():
@@ -305,38 +460,75 @@ async def add_latest_maps():
                 logging.warning(f"Could not get latest maps: {resp.status} code")
 
 
-async def _add_maps_from_json(j: dict, add_to_random_maps = True, log_replacement = True):
+async def upsert_maps(maps: list[Map]) -> list[int]:
+    '''
+    Save `maps` (unique TrackIDs) with one unordered bulk_write of upserts keyed on TrackID, and set their ids.
+    Returns the TrackIDs that were already in the db. Maps that couldn't be saved are left with id None.
+    '''
+    if len(maps) == 0: return []
+    collection = Map.get_motor_collection()
+    upserted, dupes = await _bulk_upsert(collection, maps, list(range(len(maps))))
+    if len(dupes) > 0:
+        # a concurrent ingest inserted these first; they match now, so this replaces them
+        more, _ = await _bulk_upsert(collection, maps, dupes)
+        upserted.update(more)
+    for i, _id in upserted.items():
+        maps[i].id = _id
+    replaced = [m for m in maps if m.id is None]
+    if len(replaced) > 0:
+        by_tid = {m.TrackID: m for m in replaced}
+        async for doc in collection.find({"TrackID": {"$in": list(by_tid.keys())}}, {"TrackID": 1}):
+            by_tid[doc["TrackID"]].id = doc["_id"]
+    return [m.TrackID for m in replaced if m.id is not None]
+
+async def _bulk_upsert(collection, maps: list[Map], indexes: list[int]) -> tuple[dict[int, ObjectId], list[int]]:
+    '''
+    Upsert `maps[i]` for i in `indexes` with one unordered bulk_write. Returns the ids of inserted maps by index,
+    and the indexes that failed with a duplicate key; other failures are logged.
+    '''
+    ops = [ReplaceOne({"TrackID": maps[i].TrackID}, maps[i].dict(exclude={"id", "revision_id"}), upsert=True) for i in indexes]
+    try:
+        res = await collection.bulk_write(ops, ordered=False)
+        return {indexes[i]: _id for i, _id in res.upserted_ids.items()}, []
+    except BulkWriteError as e:
+        # the other writes in the batch still went through
+        upserted = {indexes[u["index"]]: u["_id"] for u in e.details.get("upserted", [])}
+        dupes = list()
+        for err in e.details.get("writeErrors", []):
+            if err.get("code", None) == 11000:
+                dupes.append(indexes[err["index"]])
+            else:
+                logging.warning(f"Failed to save map {maps[indexes[err['index']]].TrackID}: {err.get('errmsg', err)}")
+        return upserted, dupes
+
+async def _add_maps_from_json(j: dict, add_to_random_maps = True, log_replacement = True) -> list[Map]:
+    ''' returns the (downloadable) maps that were saved '''
     if 'results' not in j:
         logging.warning(f"Response didn't contain .results")
-        return
-    map_docs = list()
-    added_c = 0
-    maps_j = j['results']
+        return []
+    start = time.time()
     track_ids = list()
-    for map_j in maps_j:
-        track_id = map_j['TrackID']
-        track_ids.append(track_id)
+    maps_by_tid: dict[int, Map] = dict()
+    for map_j in j['results']:
+        track_ids.append(map_j['TrackID'])
         _map = Map(**map_j)
-        if not _map.Downloadable:
-            continue
-        map_in_db = await Map.find_one(Eq(Map.TrackID, track_id))
-        if map_in_db is not None:
-            _map.id = map_in_db.id
-            await _map.replace()
-            if log_replacement:
-                logging.info(f"Replacing map in db: {_map.TrackID}")
-        else:
-            await _map.save()  # using insert_many later doesn't populate .id
-        if add_to_random_maps:
-            fresh_random_maps.append(_map)
-        maps_to_cache.append(_map)
-        added_c += 1
-        if track_id in known_maps:
-            continue
-        map_docs.append(_map)
-        known_maps.add(track_id)
-    for i, tid in enumerate(track_ids):
-        asyncio.create_task(cache_map(tid, delay_ms=i*100))
+        map_index.update(_map)
+        if _map.Downloadable:
+            maps_by_tid[_map.TrackID] = _map
+    saved = list(maps_by_tid.values())
+    replaced = await upsert_maps(saved)
+    saved = [m for m in saved if m.id is not None]
+    if log_replacement and len(replaced) > 0:
+        logging.info(f"Replaced maps in db: {replaced}")
+    if add_to_random_maps:
+        fresh_random_maps.extend(saved)
+    maps_to_cache.extend(saved)
+    known_maps.update(maps_by_tid.keys())
+    cache_maps(track_ids)
+    if len(saved) >= 10:
+        duration = time.time() - start
+        logging.info(f"Ingested {len(saved)} maps in {duration * 1000:.0f} ms ({len(saved) / max(duration, 1e-6):.0f} maps/s)")
+    return saved
 
 async def get_some_maps(n: int, min_secs: int = 0, max_secs: int = LONG_MAP_SECS, max_difficulty: int = 5):
     min_secs = max(15, min_secs)
@@ -346,28 +538,44 @@ async def get_some_maps(n: int, min_secs: int = 0, max_secs: int = LONG_MAP_SECS
     if max_secs % 15 != 0: raise Exception(f"max_secs % 15 != 0: {max_secs}")
     if 0 > max_difficulty or max_difficulty > 5: raise Exception(f"invalid max difficulty: {max_difficulty}")
     sent = 0
-    maps_checked = 0
-    while sent < n:
-        while len(fresh_random_maps) < n:
+    map_filter = (min_secs, max_secs, max_difficulty)
+    note_filter_demand(map_filter, n)
+    pool = filter_pools.get(map_filter, [])
+    while sent < n and len(pool) > 0:
+        yield pool.pop()
+        sent += 1
+    # fresh maps from TMX are unfiltered, so only use them when any map will do
+    if sent < n and map_filter == ANY_MAP_FILTER:
+        while len(fresh_random_maps) < n - sent:
             await add_more_random_maps(25)
-        m = fresh_random_maps.pop()
-        maps_checked += 1
-        length_ok = min_secs <= m.LengthSecs <= max_secs
-        difficulty_ok = max_difficulty >= m.DifficultyInt
-        if length_ok and difficulty_ok:
-            yield m
-            sent += 1
-        if maps_checked > 100:
-            break
+        skipped = list()
+        while sent < n and len(fresh_random_maps) > 0:
+            m = fresh_random_maps.pop()
+            if min_secs <= m.LengthSecs <= max_secs:
+                yield m
+                sent += 1
+            else:
+                skipped.append(m)
+        fresh_random_maps[:0] = skipped
+    if sent < n:
+        track_ids = map_index.sample(n - sent, min_secs, max_secs, max_difficulty)
+        maps_by_tid = {m.TrackID: m for m in await Map.find_many(In(Map.TrackID, track_ids)).to_list()}
+        for tid in track_ids:
+            if tid in maps_by_tid:
+                yield maps_by_tid[tid]
+                sent += 1
     nb_required = n - sent
     if nb_required == 0:
         await sync_random_map_queue()
         return
+    # only when the index is empty or the filter matches (almost) nothing
     extra_ids = await Map.find_many(Map.LengthSecs >= min_secs, Map.LengthSecs <= max_secs, Map.DifficultyInt <= max_difficulty, *rm_query_args(), projection_model=MapJustID).to_list()
-    track_ids = random.choices(extra_ids, k=nb_required)
+    track_ids = [m.TrackID for m in random.choices(extra_ids, k=nb_required)] if len(extra_ids) > 0 else []
     logging.info(f"Selecting {len(track_ids)} extra maps from DB.")
-    for m in await Map.find_many(In(Map.TrackID, track_ids)).to_list():
-        yield m
+    maps_by_tid = {m.TrackID: m for m in await Map.find_many(In(Map.TrackID, track_ids)).to_list()}
+    for tid in track_ids:
+        if tid in maps_by_tid:
+            yield maps_by_tid[tid]
     await sync_random_map_queue()
 
 cached_map_packs: set[int] = set()
@@ -468,7 +676,6 @@ async def maintain_totd_maps():
 totds_not_on_tmx: set[str] = set()
 
 async def update_totds(resp: dict):
-    global initialized_totds
     map_uids = set()
     for month in resp.get('monthList', []):
         for day in month.get('days', []):
@@ -500,12 +707,11 @@ async def update_totds(resp: dict):
             await m.save()
 
     logging.info(f"Ensured TOTD flag set")
-    initialized_totds = True
+    initialized_totds.set()
 
 
 async def await_initialized_totds():
-    while not initialized_totds:
-        await asyncio.sleep(0.05)
+    await initialized_totds.wait()
 
 
 async def get_maps_from_totd_maps(maps_needed: int):
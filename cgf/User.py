@@ -1,13 +1,19 @@
-import asyncio
 import logging
 import time
 
 import pymongo
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 from pydantic.dataclasses import dataclass
 
 from beanie import Document, Indexed, init_beanie
 
+from cgf.persistence import persist
+from cgf.user_activity import user_activity
+
+
+# last_seen is kept current in memory; it's written at most this often (and on scope changes/disconnects)
+LAST_SEEN_PERSIST_SECS = 5 * 60
+
 
 class User(Document):
     uid: Indexed(str, unique=True)
@@ -17,6 +23,7 @@ class User(Document):
     n_logins: int = 0
     last_seen: Indexed(float, pymongo.DESCENDING) = 0
     last_scope: str = ""
+    _last_seen_persisted: float = PrivateAttr(default=0.0)
 
     class Settings:
         use_state_management = True
@@ -38,8 +45,24 @@ class User(Document):
     # updated every time the user changes scopes -- facilitate rejoining
     def set_last_scope(self, scope: str):
         self.last_scope = scope
-        self.persist()
+        self.persist_last_seen("last_scope")
         logging.info(f"User: {self.name} set scope: {scope}")
 
+    def record_login(self, name: str | None = None):
+        if name is not None:
+            self.name = name
+        self.last_seen = time.time()
+        self.n_logins += 1
+        self.persist_last_seen("n_logins", "name")
+
+    def on_activity(self):
+        self.last_seen = time.time()
+        if self.last_seen - self._last_seen_persisted >= LAST_SEEN_PERSIST_SECS:
+            self.persist_last_seen()
+
+    def persist_last_seen(self, *other_fields: str):
+        self._last_seen_persisted = self.last_seen
+        user_activity.touch(self, "last_seen", *other_fields)
+
     def persist(self):
-        asyncio.create_task(self.save_changes())
+        persist(self)
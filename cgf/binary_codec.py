@@ -0,0 +1,157 @@
+'''
+A MessagePack encoder/decoder for JSON-like values (None, bool, int, float, str, bytes, list/tuple, dict).
+Uses the `msgpack` package when it's installed; otherwise the pure python version below.
+'''
+import struct
+
+try:
+    import msgpack as _msgpack
+except ImportError:
+    _msgpack = None
+
+
+class BinaryCodecException(Exception):
+    pass
+
+
+def _pack_into(out: bytearray, obj):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -0x20 <= obj < 0:
+            out.append(obj & 0xff)
+        elif 0 <= obj <= 0xff:
+            out += struct.pack('>BB', 0xcc, obj)
+        elif 0 <= obj <= 0xffff:
+            out += struct.pack('>BH', 0xcd, obj)
+        elif 0 <= obj <= 0xffffffff:
+            out += struct.pack('>BI', 0xce, obj)
+        elif 0 <= obj <= 0xffffffffffffffff:
+            out += struct.pack('>BQ', 0xcf, obj)
+        elif -0x80 <= obj < 0:
+            out += struct.pack('>Bb', 0xd0, obj)
+        elif -0x8000 <= obj < 0:
+            out += struct.pack('>Bh', 0xd1, obj)
+        elif -0x80000000 <= obj < 0:
+            out += struct.pack('>Bi', 0xd2, obj)
+        elif -0x8000000000000000 <= obj < 0:
+            out += struct.pack('>Bq', 0xd3, obj)
+        else:
+            raise BinaryCodecException(f"int out of range: {obj}")
+    elif isinstance(obj, float):
+        out += struct.pack('>Bd', 0xcb, obj)
+    elif isinstance(obj, str):
+        bs = obj.encode("UTF8")
+        n = len(bs)
+        if n < 32: out.append(0xa0 | n)
+        elif n <= 0xff: out += struct.pack('>BB', 0xd9, n)
+        elif n <= 0xffff: out += struct.pack('>BH', 0xda, n)
+        else: out += struct.pack('>BI', 0xdb, n)
+        out += bs
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        n = len(obj)
+        if n <= 0xff: out += struct.pack('>BB', 0xc4, n)
+        elif n <= 0xffff: out += struct.pack('>BH', 0xc5, n)
+        else: out += struct.pack('>BI', 0xc6, n)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        n = len(obj)
+        if n < 16: out.append(0x90 | n)
+        elif n <= 0xffff: out += struct.pack('>BH', 0xdc, n)
+        else: out += struct.pack('>BI', 0xdd, n)
+        for item in obj:
+            _pack_into(out, item)
+    elif isinstance(obj, dict):
+        n = len(obj)
+        if n < 16: out.append(0x80 | n)
+        elif n <= 0xffff: out += struct.pack('>BH', 0xde, n)
+        else: out += struct.pack('>BI', 0xdf, n)
+        for k, v in obj.items():
+            _pack_into(out, k)
+            _pack_into(out, v)
+    else:
+        raise BinaryCodecException(f"cannot encode type: {type(obj)}")
+
+
+def packb(obj) -> bytes:
+    if _msgpack is not None:
+        return _msgpack.packb(obj, use_bin_type=True)
+    out = bytearray()
+    _pack_into(out, obj)
+    return bytes(out)
+
+
+# (struct format, size) for fixed-width types
+_FIXED = {
+    0xca: ('>f', 4), 0xcb: ('>d', 8),
+    0xcc: ('>B', 1), 0xcd: ('>H', 2), 0xce: ('>I', 4), 0xcf: ('>Q', 8),
+    0xd0: ('>b', 1), 0xd1: ('>h', 2), 0xd2: ('>i', 4), 0xd3: ('>q', 8),
+}
+# length prefix formats for str / bin / array / map
+_LENGTHS = {
+    0xd9: ('>B', 1), 0xda: ('>H', 2), 0xdb: ('>I', 4),
+    0xc4: ('>B', 1), 0xc5: ('>H', 2), 0xc6: ('>I', 4),
+    0xdc: ('>H', 2), 0xdd: ('>I', 4),
+    0xde: ('>H', 2), 0xdf: ('>I', 4),
+}
+
+
+def _unpack_from(bs: bytes, pos: int):
+    b = bs[pos]
+    pos += 1
+    if b < 0x80: return b, pos
+    if b >= 0xe0: return b - 0x100, pos
+    if b == 0xc0: return None, pos
+    if b == 0xc2: return False, pos
+    if b == 0xc3: return True, pos
+    if 0xa0 <= b <= 0xbf:
+        n = b & 0x1f
+        return str(bs[pos:pos+n], "UTF8"), pos + n
+    if 0x90 <= b <= 0x9f:
+        return _unpack_array(bs, pos, b & 0x0f)
+    if 0x80 <= b <= 0x8f:
+        return _unpack_map(bs, pos, b & 0x0f)
+    if b in _FIXED:
+        fmt, size = _FIXED[b]
+        return struct.unpack_from(fmt, bs, pos)[0], pos + size
+    if b in _LENGTHS:
+        fmt, size = _LENGTHS[b]
+        n, = struct.unpack_from(fmt, bs, pos)
+        pos += size
+        if b in (0xd9, 0xda, 0xdb): return str(bs[pos:pos+n], "UTF8"), pos + n
+        if b in (0xc4, 0xc5, 0xc6): return bytes(bs[pos:pos+n]), pos + n
+        if b in (0xdc, 0xdd): return _unpack_array(bs, pos, n)
+        return _unpack_map(bs, pos, n)
+    raise BinaryCodecException(f"unsupported type byte: {b:#x}")
+
+
+def _unpack_array(bs: bytes, pos: int, n: int):
+    ret = []
+    for _ in range(n):
+        item, pos = _unpack_from(bs, pos)
+        ret.append(item)
+    return ret, pos
+
+
+def _unpack_map(bs: bytes, pos: int, n: int):
+    ret = dict()
+    for _ in range(n):
+        k, pos = _unpack_from(bs, pos)
+        v, pos = _unpack_from(bs, pos)
+        ret[k] = v
+    return ret, pos
+
+
+def unpackb(bs: bytes):
+    if _msgpack is not None:
+        return _msgpack.unpackb(bs, raw=False)
+    obj, pos = _unpack_from(bs, 0)
+    if pos != len(bs):
+        raise BinaryCodecException(f"trailing bytes: {len(bs) - pos}")
+    return obj
@@ -0,0 +1,82 @@
+import asyncio
+from collections import OrderedDict
+import logging
+import zlib
+
+
+# frames with a smaller body are sent uncompressed
+COMPRESS_MIN_BYTES = 512
+COMPRESS_LEVEL = 6
+# number of recently compressed bodies to keep, so identical payloads are only compressed once
+CACHE_SIZE = 64
+
+# Preset dictionary for the repetitive parts of our JSON. Clients get it in CAPABILITIES_ACK.
+# zlib favours matches near the end of the dictionary, so the most common strings go last.
+ZDICT_VERSION = 1
+ZDICT = ''.join([
+    '"Tags":"', '"TypeName":"Race",', '"StyleName":"', '"HasThumbnail":true',
+    '"DifficultyName":"Intermediate', '"DifficultyName":"Advanced', '"DifficultyName":"Beginner',
+    '"LengthName":"', '"LengthSecs":', '"LengthEnum":', '"AuthorTime":',
+    '{"TrackID":', '"TrackUID":"', '"Name":"', '$s$o', '$fff',
+    '"game_opts":{', '"use_club_room":false,', '"cr_join_link":"', '"map_pack":null,', '"use_totd":false,',
+    '"game_start_time":-1,', '"started":false,', '"max_difficulty":"', '"min_secs":', '"max_secs":',
+    '"n_maps":', '"is_open":true,', '"is_public":true,', '"player_limit":', '"n_teams":',
+    '"n_players":', '"ready_count":', '"n_clients":', '"n_rooms":', '"n_public_rooms":', '"rooms":[',
+    '{"name":"', '"uid":"', '"username":"', '"last_seen":',
+    '"visibility":"global","from":{"uid":"', '"ts":', '"seq":',
+    '{"type":"', '","payload":{',
+]).encode("UTF8")
+
+
+_cache: OrderedDict[tuple[bytes, bool], bytes] = OrderedDict()
+
+# message type -> [frames, uncompressed body bytes, sent body bytes]
+stats: dict[str, list[int]] = dict()
+
+
+def deflate(body: bytes, use_zdict: bool) -> bytes:
+    key = (body, use_zdict)
+    comp = _cache.get(key, None)
+    if comp is not None:
+        _cache.move_to_end(key)
+        return comp
+    if use_zdict:
+        c = zlib.compressobj(COMPRESS_LEVEL, zdict=ZDICT)
+        comp = c.compress(body) + c.flush()
+    else:
+        comp = zlib.compress(body, COMPRESS_LEVEL)
+    _cache[key] = comp
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return comp
+
+
+def inflate(comp: bytes, use_zdict: bool) -> bytes:
+    if use_zdict:
+        d = zlib.decompressobj(zdict=ZDICT)
+        return d.decompress(comp) + d.flush()
+    return zlib.decompress(comp)
+
+
+def record(msg_type: str | None, raw_len: int, sent_len: int):
+    s = stats.get(msg_type, None)
+    if s is None:
+        s = stats[msg_type] = [0, 0, 0]
+    s[0] += 1
+    s[1] += raw_len
+    s[2] += sent_len
+
+
+def stats_report() -> list[str]:
+    lines = []
+    for msg_type, (n, raw, sent) in sorted(stats.items(), key=lambda kv: kv[1][2] - kv[1][1]):
+        pct = 0 if raw == 0 else 100 * (raw - sent) / raw
+        lines.append(f"{msg_type}: {n} frames, {raw} -> {sent} bytes, saved {raw - sent} ({pct:.1f}%)")
+    return lines
+
+
+async def log_stats_loop(interval: float = 60 * 10):
+    while True:
+        await asyncio.sleep(interval)
+        if len(stats) == 0: continue
+        logging.info("Compression stats (bytes saved per message type):\n  " + "\n  ".join(stats_report()))
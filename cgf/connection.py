@@ -0,0 +1,175 @@
+import asyncio
+from collections import deque
+import logging
+import struct
+from typing import Callable
+
+from cgf.framing import MAX_FRAME_LEN
+
+
+HEADER_LEN = 2
+INITIAL_BUF_SIZE = 4096
+MAX_BUF_SIZE = HEADER_LEN + MAX_FRAME_LEN
+# stop reading from the socket while this many parsed frames are waiting to be processed
+MAX_INBOX = 256
+
+
+class FrameError(Exception):
+    pass
+
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    '''
+    Reads length-prefixed frames straight into a receive buffer and parses every
+    complete frame in it at once. PING and END are filtered on the raw bytes;
+    other frames are queued as bytes for `read_frame` (json_codec decodes them directly).
+    '''
+    transport: asyncio.Transport | None
+    inbox: deque[bytes]
+
+    def __init__(self, on_connection: Callable[["FrameProtocol"], None]):
+        self.on_connection = on_connection
+        self.on_activity: Callable[[], None] | None = None
+        self.transport = None
+        self.buf = bytearray(INITIAL_BUF_SIZE)
+        self.view = memoryview(self.buf)
+        self.n_buffered = 0
+        self.inbox = deque()
+        self.inbox_ready = asyncio.Event()
+        self.at_eof = False
+        self.end_received = False
+        self.reading_paused = False
+        self.writing_paused = False
+        self.drain_waiter: asyncio.Future | None = None
+
+    # --- asyncio.BufferedProtocol
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        self.on_connection(self)
+
+    def get_buffer(self, sizehint: int):
+        if self.n_buffered == len(self.buf):
+            self.grow_buffer()
+        return self.view[self.n_buffered:]
+
+    def buffer_updated(self, nbytes: int):
+        self.n_buffered += nbytes
+        self.parse_frames()
+
+    def eof_received(self):
+        self.feed_eof()
+        # close the transport ourselves
+        return False
+
+    def connection_lost(self, exc: Exception | None):
+        self.feed_eof()
+        self.writing_paused = False
+        self.wake_drain_waiter(exc)
+
+    def pause_writing(self):
+        self.writing_paused = True
+
+    def resume_writing(self):
+        self.writing_paused = False
+        self.wake_drain_waiter(None)
+
+    # --- parsing
+
+    def grow_buffer(self):
+        if len(self.buf) >= MAX_BUF_SIZE:
+            raise FrameError(f"receive buffer full ({len(self.buf)})")
+        new_buf = bytearray(min(MAX_BUF_SIZE, len(self.buf) * 2))
+        new_buf[:self.n_buffered] = self.view[:self.n_buffered]
+        self.view.release()
+        self.buf = new_buf
+        self.view = memoryview(new_buf)
+
+    def parse_frames(self):
+        view = self.view
+        end = self.n_buffered
+        pos = 0
+        n_frames = 0
+        while end - pos >= HEADER_LEN and not self.end_received:
+            msg_len, = struct.unpack_from('<H', self.buf, pos)
+            frame_end = pos + HEADER_LEN + msg_len
+            if frame_end > end:
+                # partial frame; make sure it will fit once it all arrives
+                while frame_end - pos > len(self.buf):
+                    self.grow_buffer()
+                    view = self.view
+                break
+            body = view[pos + HEADER_LEN:frame_end]
+            pos = frame_end
+            n_frames += 1
+            if body == b"PING":
+                continue
+            if body == b"END":
+                self.end_received = True
+                break
+            self.inbox.append(bytes(body))
+        if pos > 0:
+            # keep any partial frame at the start of the buffer
+            remaining = end - pos
+            self.buf[:remaining] = self.buf[pos:end]
+            self.n_buffered = remaining
+        if n_frames > 0:
+            if self.on_activity is not None:
+                self.on_activity()
+            if len(self.inbox) > 0 or self.end_received:
+                self.inbox_ready.set()
+            if len(self.inbox) >= MAX_INBOX and not self.reading_paused and self.transport is not None:
+                self.reading_paused = True
+                self.transport.pause_reading()
+
+    def feed_eof(self):
+        self.at_eof = True
+        self.inbox_ready.set()
+
+    async def read_frame(self) -> bytes | None:
+        '''the next JSON frame's body, or None after END/EOF.'''
+        while len(self.inbox) == 0:
+            if self.end_received or self.at_eof:
+                return None
+            self.inbox_ready.clear()
+            await self.inbox_ready.wait()
+        frame = self.inbox.popleft()
+        if self.reading_paused and len(self.inbox) < MAX_INBOX // 2 and not self.at_eof:
+            self.reading_paused = False
+            self.transport.resume_reading()
+        return frame
+
+    # --- writing
+
+    def is_closing(self) -> bool:
+        return self.transport is None or self.transport.is_closing()
+
+    def write(self, frame: bytes):
+        self.transport.write(frame)
+
+    def writelines(self, frames: list[bytes]):
+        self.transport.writelines(frames)
+
+    def wake_drain_waiter(self, exc: Exception | None):
+        waiter = self.drain_waiter
+        self.drain_waiter = None
+        if waiter is None or waiter.done(): return
+        if exc is None:
+            waiter.set_result(None)
+        else:
+            waiter.set_exception(exc)
+
+    async def drain(self):
+        if self.transport.is_closing():
+            raise ConnectionResetError("Connection lost")
+        if not self.writing_paused:
+            return
+        self.drain_waiter = asyncio.get_running_loop().create_future()
+        await self.drain_waiter
+
+    def close(self):
+        if self.transport is None or self.transport.is_closing(): return
+        if self.transport.can_write_eof():
+            self.transport.write_eof()
+        self.transport.close()
+        logging.debug(f"Closed connection: {self.transport.get_extra_info('peername')}")
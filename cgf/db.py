@@ -1,9 +1,11 @@
+import os
 from pathlib import Path
 from motor.motor_asyncio import AsyncIOMotorClient
 import boto3
 import botocore
 
 db = AsyncIOMotorClient(Path('.mongodb').read_text().strip())
+MAIN_DB_NAME = os.environ.get("CGF_DB_NAME", "cgf_db")
 
 s3_access_key = None
 s3_secret_key = None
@@ -0,0 +1,144 @@
+from dataclasses import dataclass
+import struct
+
+from cgf.binary_codec import packb
+from cgf import json_codec
+import cgf.compression as compression
+
+
+# legacy frames are a little-endian u16 length followed by that many bytes of UTF8 JSON
+MAX_FRAME_LEN = 2**16 - 1
+# extended frames (negotiated via CAPABILITIES) are a u32 length, a flags byte, then the body
+MAX_EXT_FRAME_LEN = 2**32 - 1
+EXT_HEADER = struct.Struct('<IB')
+
+# extended frame flags
+FLAG_MSGPACK = 0x01
+FLAG_DEFLATE = 0x02
+# deflated with compression.ZDICT as the preset dictionary
+FLAG_ZDICT = 0x04
+
+
+class MsgException(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class WireFormat:
+    extended: bool = False
+    msgpack: bool = False
+    deflate: bool = False
+    zdict: bool = False
+
+    @property
+    def to_json(self):
+        ret = dict(
+            frames="u32" if self.extended else "u16",
+            codecs=["msgpack"] if self.msgpack else [],
+            compression=["deflate"] if self.deflate else [],
+            min_compress_bytes=compression.COMPRESS_MIN_BYTES)
+        if self.zdict:
+            ret['zdict'] = dict(version=compression.ZDICT_VERSION, dict=compression.ZDICT.decode("UTF8"))
+        return ret
+
+    @classmethod
+    def from_capabilities(cls, caps: dict):
+        extended = caps.get('frames', None) == "u32"
+        codecs = caps.get('codecs', [])
+        msgpack = extended and isinstance(codecs, list) and "msgpack" in codecs
+        comp = caps.get('compression', [])
+        deflate = extended and isinstance(comp, list) and "deflate" in comp
+        zdict = deflate and caps.get('zdict', None) == compression.ZDICT_VERSION
+        return cls(extended=extended, msgpack=msgpack, deflate=deflate, zdict=zdict)
+
+
+LEGACY_WIRE = WireFormat()
+
+
+def encode_frame_bytes(body: bytes) -> bytes:
+    if len(body) > MAX_FRAME_LEN:
+        raise MsgException(f"msg too long ({len(body)})")
+    return struct.pack('<H', len(body)) + body
+
+
+def encode_ext_frame_bytes(body: bytes, flags: int = 0) -> bytes:
+    if len(body) + 1 > MAX_EXT_FRAME_LEN:
+        raise MsgException(f"msg too long ({len(body)})")
+    return EXT_HEADER.pack(len(body) + 1, flags) + body
+
+
+def encode_frame(data: dict) -> bytes:
+    '''serialize `data` once; the result can be written to any number of legacy clients.'''
+    return encode_frame_bytes(json_codec.dumps(data))
+
+
+def encode_frame_str(msg: str, wire: WireFormat = LEGACY_WIRE) -> bytes:
+    if wire.extended:
+        return encode_ext_frame_bytes(msg.encode("UTF8"))
+    return encode_frame_bytes(msg.encode("UTF8"))
+
+
+def uses_msgpack(data: dict) -> bool:
+    # only game messages are sent as msgpack
+    t = data.get('type', None)
+    return isinstance(t, str) and t.startswith("G_")
+
+
+class OutMsg:
+    '''
+    A message to be written to one or more clients. Each wire format is encoded at most once,
+    so a broadcast costs one serialization per format in use rather than one per client.
+    `json_body` can be passed if `data` was already JSON encoded.
+    '''
+    data: dict
+    key: str | None
+    frames: dict[WireFormat, bytes]
+    # (uncompressed, sent) body sizes for compressing wire formats
+    sizes: dict[WireFormat, tuple[int, int]]
+
+    def __init__(self, data: dict, key: str | None = None, json_body: bytes | None = None):
+        self.data = data
+        self.key = key
+        self.frames = dict()
+        self.sizes = dict()
+        self._json_body = json_body
+
+    @property
+    def json_body(self) -> bytes:
+        if self._json_body is None:
+            self._json_body = json_codec.dumps(self.data)
+        return self._json_body
+
+    @property
+    def stats_type(self) -> str | None:
+        return self.data.get('type', next(iter(self.data), None))
+
+    def frame_for(self, wire: WireFormat) -> bytes:
+        frame = self.frames.get(wire, None)
+        if frame is None:
+            frame = self.frames[wire] = self.encode(wire)
+        if wire.deflate:
+            compression.record(self.stats_type, *self.sizes[wire])
+        return frame
+
+    def msgpack_body(self) -> bytes | None:
+        ''' the body for clients that negotiated msgpack, or None to send JSON '''
+        return packb(self.data) if uses_msgpack(self.data) else None
+
+    def encode(self, wire: WireFormat) -> bytes:
+        if not wire.extended:
+            return encode_frame_bytes(self.json_body)
+        flags = 0
+        body = self.json_body
+        packed = self.msgpack_body() if wire.msgpack else None
+        if packed is not None:
+            flags |= FLAG_MSGPACK
+            body = packed
+        raw_len = len(body)
+        if wire.deflate and raw_len >= compression.COMPRESS_MIN_BYTES:
+            comp = compression.deflate(body, wire.zdict)
+            if len(comp) < raw_len:
+                body = comp
+                flags |= FLAG_DEFLATE | (FLAG_ZDICT if wire.zdict else 0)
+        self.sizes[wire] = (raw_len, len(body))
+        return encode_ext_frame_bytes(body, flags)
@@ -0,0 +1,49 @@
+'''
+All JSON encoding/decoding goes through here. Uses orjson when it's installed, otherwise stdlib json.
+Encoding produces compact JSON with non-ASCII characters escaped (as json.dumps always did),
+so the wire format doesn't depend on which backend is installed; decoding accepts bytes/bytearray/memoryview/str.
+orjson and msgpack are in the `fast` extra: `poetry install -E fast`.
+'''
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BACKEND = "json" if orjson is None else "orjson"
+
+
+_ascii_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+if orjson is not None:
+    _ORJSON_OPTS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj) -> bytes:
+        bs = orjson.dumps(obj, option=_ORJSON_OPTS)
+        # orjson can't escape non-ASCII; such messages are rare, so re-encode them with the stdlib
+        return bs if bs.isascii() else _ascii_encoder.encode(obj).encode("UTF8")
+
+    def loads(bs: bytes | bytearray | memoryview | str):
+        return orjson.loads(bs)
+
+    def pydantic_dumps(obj, *, default=None, **kwargs) -> str:
+        return orjson.dumps(obj, default=default, option=_ORJSON_OPTS).decode("UTF8")
+
+else:
+    def dumps(obj) -> bytes:
+        return _ascii_encoder.encode(obj).encode("UTF8")
+
+    def loads(bs: bytes | bytearray | memoryview | str):
+        if isinstance(bs, memoryview):
+            bs = bytes(bs)
+        return json.loads(bs)
+
+    def pydantic_dumps(obj, *, default=None, **kwargs) -> str:
+        return json.dumps(obj, default=default, ensure_ascii=False, separators=(',', ':'))
+
+
+def dumps_str(obj) -> str:
+    return dumps(obj).decode("UTF8")
@@ -0,0 +1,98 @@
+'''
+In-memory index of the maps that can be handed out as random maps (the same ones `rm_query_args` matches),
+bucketed by LengthEnum x DifficultyInt. Sampling for a room's length/difficulty filter only looks at the
+buckets that overlap it, so it costs O(k) and never touches the db.
+'''
+from bisect import bisect_right
+from itertools import accumulate
+import random
+
+from cgf.models.Map import Map, MapEligibility, length_secs_to_enum
+
+
+BucketKey = tuple[int, int]
+# (TrackID, LengthSecs)
+Entry = tuple[int, int]
+
+
+def is_random_map_eligible(m: Map) -> bool:
+    ''' in-memory version of RandomMapCacher.rm_query_args '''
+    return m.Downloadable and not m.Unreleased and not m.Unlisted and m.MapType == "TM_Race" and m.DifficultyInt is not None
+
+
+class MapIndex:
+    buckets: dict[BucketKey, list[Entry]]
+    # TrackID -> (bucket, position in bucket)
+    where: dict[int, tuple[BucketKey, int]]
+
+    def __init__(self):
+        self.buckets = dict()
+        self.where = dict()
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, track_id: int):
+        return track_id in self.where
+
+    def add(self, track_id: int, length_secs: int, difficulty: int):
+        key = (length_secs_to_enum(length_secs), difficulty)
+        current = self.where.get(track_id, None)
+        if current is not None:
+            if current[0] == key:
+                self.buckets[key][current[1]] = (track_id, length_secs)
+                return
+            self.remove(track_id)
+        bucket = self.buckets.setdefault(key, list())
+        self.where[track_id] = (key, len(bucket))
+        bucket.append((track_id, length_secs))
+
+    def remove(self, track_id: int):
+        current = self.where.pop(track_id, None)
+        if current is None: return
+        key, pos = current
+        bucket = self.buckets[key]
+        last = bucket.pop()
+        # swap the last entry into the hole
+        if pos < len(bucket):
+            bucket[pos] = last
+            self.where[last[0]] = (key, pos)
+
+    def update(self, m: Map | MapEligibility):
+        ''' add or remove `m` depending on whether it can be a random map '''
+        eligible = is_random_map_eligible(m) if isinstance(m, Map) else m.DifficultyInt is not None
+        if eligible:
+            self.add(m.TrackID, m.LengthSecs, m.DifficultyInt)
+        else:
+            self.remove(m.TrackID)
+
+    def sample(self, k: int, min_secs: int, max_secs: int, max_difficulty: int) -> list[int]:
+        '''
+        Up to `k` random TrackIDs with min_secs <= LengthSecs <= max_secs and DifficultyInt <= max_difficulty.
+        IDs are distinct unless fewer than `k` maps match, in which case some are repeated.
+        '''
+        if k <= 0: return []
+        min_enum, max_enum = length_secs_to_enum(min_secs), length_secs_to_enum(max_secs)
+        buckets = [b for (length_enum, difficulty), b in self.buckets.items()
+            if min_enum <= length_enum <= max_enum and difficulty <= max_difficulty and len(b) > 0]
+        if len(buckets) == 0: return []
+        ends = list(accumulate(len(b) for b in buckets))
+        total = ends[-1]
+        if total <= k:
+            tids = [tid for b in buckets for tid, secs in b if min_secs <= secs <= max_secs]
+            if len(tids) == 0: return []
+            random.shuffle(tids)
+            return tids + random.choices(tids, k=k - len(tids))
+        # buckets at either end of the length range can hold a few maps just outside it, so those draws are retried
+        picked: dict[int, None] = dict()
+        for _ in range(4 * k + 16):
+            if len(picked) >= k: break
+            i = random.randrange(total)
+            b = bisect_right(ends, i)
+            tid, secs = buckets[b][i - (ends[b - 1] if b > 0 else 0)]
+            if min_secs <= secs <= max_secs:
+                picked[tid] = None
+        return list(picked)
+
+
+map_index = MapIndex()
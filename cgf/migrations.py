@@ -0,0 +1,90 @@
+'''
+One-shot migrations for data stored under older schemas. Each one only touches docs that haven't been
+migrated yet, so they're cheap to run on every startup (before lobbies/rooms/games are loaded).
+'''
+import logging
+import time
+
+from bson import DBRef
+from pymongo.errors import BulkWriteError
+
+from cgf.Client import N_RECENT_CHATS, ChatLine, GameEvent, GameSession, Message
+from cgf.User import User
+
+
+def _ref_id(ref):
+    return ref.id if isinstance(ref, DBRef) else ref["$id"]
+
+
+async def _insert_ignoring_dupes(collection, docs: list[dict]):
+    ''' a previous run may have been interrupted after inserting some of these '''
+    if len(docs) == 0: return
+    try:
+        await collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        if any(err.get("code", None) != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+
+
+async def migrate_game_msgs():
+    ''' GameSession.game_msgs (links to Message docs) -> GameEvent rows with seq = list index, and n_game_msgs '''
+    games = GameSession.get_motor_collection()
+    events = GameEvent.get_motor_collection()
+    messages = Message.get_motor_collection()
+    start = time.time()
+    n_games = 0
+    n_events = 0
+    async for raw in games.find({"game_msgs.0": {"$exists": True}}, {"name": 1, "game_msgs": 1}):
+        ids = [_ref_id(ref) for ref in raw["game_msgs"]]
+        msgs = {m["_id"]: m async for m in messages.find({"_id": {"$in": ids}})}
+        docs = list()
+        for seq, _id in enumerate(ids):
+            m = msgs.get(_id, None)
+            if m is None:
+                logging.warning(f"[Migration] Game {raw['name']}: message {_id} (seq {seq}) is missing")
+                continue
+            docs.append(dict(game=raw["name"], seq=seq, type=m["type"], payload=m["payload"],
+                visibility=m.get("visibility", "global"), user=m.get("user", None), ts=m.get("ts", start)))
+        await _insert_ignoring_dupes(events, docs)
+        await games.update_one({"_id": raw["_id"]}, {"$set": {"n_game_msgs": len(ids)}, "$unset": {"game_msgs": ""}})
+        n_games += 1
+        n_events += len(docs)
+    if n_games > 0:
+        logging.info(f"[Migration] Moved {n_events} game messages of {n_games} games to GameEvent in {time.time() - start:.1f}s")
+
+
+async def migrate_recent_chat(users: dict[str, User], n_recent: int = N_RECENT_CHATS):
+    '''
+    The last `n_recent` messages of each old ChatMessages doc (links to Message docs) -> ChatLine rows,
+    so recent chat still shows after the switch. Older chat stays in Message.
+    '''
+    lines = ChatLine.get_motor_collection()
+    chats = lines.database["ChatMessages"]
+    messages = Message.get_motor_collection()
+    uid_by_id = {u.id: u.uid for u in users.values()}
+    start = time.time()
+    n_containers = 0
+    n_lines = 0
+    async for raw in chats.find({"migrated_to_chatline": {"$ne": True}}):
+        container_type = next((t for t in ("lobby", "room", "game") if raw.get(t, None) is not None), None)
+        ids = [_ref_id(ref) for ref in raw.get("msgs", [])[-n_recent:]]
+        if container_type is not None and len(ids) > 0:
+            name = raw[container_type]
+            # an interrupted run may have copied some of these already
+            copied = set()
+            async for line in lines.find({"container_type": container_type, "container_name": name}, {"ts": 1}).sort("ts", 1).limit(n_recent):
+                copied.add(line["ts"])
+            docs = list()
+            async for m in messages.find({"_id": {"$in": ids}}):
+                if m.get("ts", None) in copied: continue
+                user = m.get("user", None)
+                docs.append(dict(container_type=container_type, container_name=name, ts=m.get("ts", start),
+                    user_uid=None if user is None else uid_by_id.get(_ref_id(user), None),
+                    type=m["type"], payload=m["payload"], visibility=m.get("visibility", "global")))
+            if len(docs) > 0:
+                await lines.insert_many(docs, ordered=False)
+            n_lines += len(docs)
+        await chats.update_one({"_id": raw["_id"]}, {"$set": {"migrated_to_chatline": True}})
+        n_containers += 1
+    if n_containers > 0:
+        logging.info(f"[Migration] Copied {n_lines} recent chat messages of {n_containers} lobbies/rooms/games to ChatLine in {time.time() - start:.1f}s")
@@ -1,11 +1,12 @@
 import datetime
-import json
 import logging
 
 from pydantic import Field, BaseModel
 from beanie import Document, Indexed
 import pymongo
 
+from cgf import json_codec
+
 LONG_MAP_SECS = 315
 
 """Length Enums:
@@ -72,6 +73,12 @@ class MapJustID(BaseModel):
     TrackID: int
 
 
+class MapEligibility(BaseModel):
+    TrackID: int
+    LengthSecs: int
+    DifficultyInt: int | None
+
+
 class Map(Document):
     TrackID: Indexed(int, unique=True)
     UserID: Indexed(int)
@@ -114,6 +121,10 @@ class Map(Document):
     MapType: str | None
     WasTOTD: bool = False
 
+    class Config:
+        json_dumps = json_codec.pydantic_dumps
+        json_loads = json_codec.loads
+
     class Settings:
         indexes = \
             [ "MapType"
@@ -150,7 +161,10 @@ class Map(Document):
 
     @property
     def safe_json(self) -> dict:
-        return json.loads(self.json())
+        d = self.dict()
+        # the only field that isn't already a JSON type
+        d['id'] = None if self.id is None else str(self.id)
+        return d
 
     @property
     def safe_json_shorter(self):
@@ -0,0 +1,111 @@
+import asyncio
+from collections import deque
+import logging
+import time
+from typing import Callable
+
+from cgf.connection import FrameProtocol
+
+
+# periodic snapshots; a newer copy drops any older unsent copy and is queued at the tail
+SNAPSHOT_MSG_TYPES = {"ROOM_INFO", "LOBBY_INFO", "GAME_INFO", "ROOM_STATE", "LOBBY_STATE", "GAME_STATE", "server"}
+
+# bytes queued (ours + the transport's buffer)
+OUTBOUND_HIGH_WATER = 256 * 1024
+OUTBOUND_LOW_WATER = 64 * 1024
+# disconnect a client that stays above the high water mark for this long
+SLOW_CONSUMER_TIMEOUT = 30.0
+
+
+def snapshot_key(data: dict) -> str | None:
+    key = data.get('type', 'server' if 'server' in data else None)
+    return key if key in SNAPSHOT_MSG_TYPES else None
+
+
+class OutboundQueue:
+    '''Per-client queue of encoded frames, written out by a single writer task.'''
+    conn: FrameProtocol
+    frames: deque[list]
+    snapshots: dict[str, list]
+    n_bytes: int
+    over_budget_since: float | None
+
+    def __init__(self, conn: FrameProtocol, on_slow_consumer: Callable[[], None]):
+        self.conn = conn
+        self.on_slow_consumer = on_slow_consumer
+        self.frames = deque()
+        self.snapshots = dict()
+        self.n_bytes = 0
+        self.over_budget_since = None
+        self.closed = False
+        self.wakeup = asyncio.Event()
+        conn.transport.set_write_buffer_limits(high=OUTBOUND_HIGH_WATER, low=OUTBOUND_LOW_WATER)
+        self.task = asyncio.create_task(self.run())
+
+    @property
+    def depth(self) -> int:
+        return self.n_bytes + self.conn.transport.get_write_buffer_size()
+
+    @property
+    def n_frames(self) -> int:
+        return len(self.frames)
+
+    def put(self, frame: bytes, key: str | None = None):
+        if self.closed or self.conn.is_closing(): return
+        if key is not None and key in self.snapshots:
+            # leave a hole where the stale copy was, so it's not sent ahead of frames queued after it
+            stale = self.snapshots[key]
+            self.n_bytes -= len(stale[1])
+            stale[1] = None
+        entry = [key, frame]
+        self.frames.append(entry)
+        self.n_bytes += len(frame)
+        if key is not None:
+            self.snapshots[key] = entry
+        self.wakeup.set()
+        self.check_budget()
+
+    def pop_all(self) -> list[bytes]:
+        frames = [frame for _, frame in self.frames if frame is not None]
+        self.frames.clear()
+        self.snapshots.clear()
+        self.n_bytes = 0
+        return frames
+
+    def check_budget(self):
+        depth = self.depth
+        if depth > OUTBOUND_HIGH_WATER:
+            if self.over_budget_since is None:
+                self.over_budget_since = time.time()
+            elif time.time() - self.over_budget_since > SLOW_CONSUMER_TIMEOUT:
+                logging.warning(f"Slow consumer: {depth} bytes queued for {time.time() - self.over_budget_since:.1f}s")
+                self.close(flush=False)
+                # not from inside put(): the caller may be iterating over the clients the eviction removes this one from
+                asyncio.get_running_loop().call_soon(self.on_slow_consumer)
+        elif depth < OUTBOUND_LOW_WATER:
+            self.over_budget_since = None
+
+    async def run(self):
+        try:
+            while not self.closed:
+                # the writer task only runs once the current loop iteration is done, so
+                # everything queued during that iteration goes out in a single write
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                frames = self.pop_all()
+                if len(frames) > 0 and not self.closed:
+                    self.conn.writelines(frames)
+                    # only blocks while the transport is above its high water mark
+                    await self.conn.drain()
+                    self.check_budget()
+        except (ConnectionError, asyncio.CancelledError):
+            self.closed = True
+
+    def close(self, flush=True):
+        ''' Stop the writer task. If `flush`, pending frames are handed to the transport first. '''
+        if self.closed: return
+        self.closed = True
+        frames = self.pop_all()
+        if flush and len(frames) > 0 and not self.conn.is_closing():
+            self.conn.writelines(frames)
+        self.task.cancel()
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+
+from beanie import Document
+from beanie.exceptions import StateNotSaved
+
+
+# a dirty document is written at most once per interval
+FLUSH_INTERVAL = 1.0
+
+
+class DirtyFlusher:
+    '''
+    Coalesces writes to state-managed documents. `mark` records that a document changed; once per
+    `interval` every dirty document gets one `$set` of all fields changed since its last save. Flushes
+    run one at a time, so writes to the same document never overlap.
+    '''
+    dirty: dict[int, Document]
+
+    def __init__(self, interval: float = FLUSH_INTERVAL):
+        self.interval = interval
+        self.dirty = dict()
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.flushing: asyncio.Task | None = None
+        # marks, marks on an already-dirty doc (no extra write), writes issued, writes failed
+        self.n_marked = 0
+        self.n_coalesced = 0
+        self.n_issued = 0
+        self.n_failed = 0
+
+    def mark(self, doc: Document):
+        self.n_marked += 1
+        if id(doc) in self.dirty:
+            self.n_coalesced += 1
+            return
+        self.dirty[id(doc)] = doc
+        self.wakeup.set()
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(self.interval)
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        ''' write every dirty document now (also used on shutdown) '''
+        while self.flushing is not None:
+            await asyncio.shield(self.flushing)
+        if len(self.dirty) == 0: return
+        batch, self.dirty = list(self.dirty.values()), dict()
+        self.flushing = asyncio.create_task(self.write_batch(batch))
+        try:
+            await asyncio.shield(self.flushing)
+        finally:
+            self.flushing = None
+
+    async def write_batch(self, batch: list[Document]):
+        await asyncio.gather(*[self.write(doc) for doc in batch])
+
+    async def write(self, doc: Document):
+        try:
+            if not doc.is_changed: return
+            changes = doc.get_changes()
+        except StateNotSaved:
+            # not inserted yet; whoever creates it saves the current state
+            return
+        # save_changes() would record the saved state after its await, so a change made during the write
+        # would count as saved without being written. Record it before, and write with a plain $set.
+        saved_state = doc._saved_state
+        doc._save_state()
+        try:
+            await doc.get_motor_collection().update_one({"_id": doc.id}, {"$set": changes})
+            self.n_issued += 1
+        except Exception as e:
+            self.n_failed += 1
+            # these changes are still unwritten; the next save includes them
+            doc._saved_state = saved_state
+            logging.warning(f"[DirtyFlusher] Failed to save {type(doc).__name__} {doc.id}: {e}")
+
+    def stats_report(self) -> str:
+        pct = 0 if self.n_marked == 0 else 100 * self.n_coalesced / self.n_marked
+        return f"{self.n_marked} marked, {self.n_issued} writes issued, {self.n_coalesced} coalesced ({pct:.1f}%), {self.n_failed} failed, {len(self.dirty)} pending"
+
+
+flusher = DirtyFlusher()
+
+
+def persist(doc: Document):
+    ''' schedule a (coalesced) save_changes for `doc` '''
+    flusher.mark(doc)
+
+
+async def log_stats_loop(interval: float = 60 * 10):
+    while True:
+        await asyncio.sleep(interval)
+        logging.info(f"Dirty document writes: {flusher.stats_report()}")
@@ -0,0 +1,64 @@
+'''
+Process-wide index of live rooms and games, so joins and rejoins don't need to query the db.
+Rooms are added once their model is saved (or loaded) and removed when they're retired.
+An entry for a live room or game is never replaced by another controller.
+'''
+import logging
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from cgf.Client import GameController, RoomController
+
+
+rooms_by_name: dict[str, "RoomController"] = dict()
+rooms_by_join_code: dict[str, "RoomController"] = dict()
+rooms_by_cr_activity_id: dict[int, "RoomController"] = dict()
+games_by_name: dict[str, "GameController"] = dict()
+
+
+def _add(index: dict, key, value, what: str) -> bool:
+    existing = index.get(key, None)
+    if existing is not None and existing is not value:
+        logging.warning(f"[Registry] Not replacing live {what} {key!r} with another controller")
+        return False
+    index[key] = value
+    return True
+
+
+def register_room(room: "RoomController"):
+    if not _add(rooms_by_name, room.name, room, "room"): return
+    _add(rooms_by_join_code, room.model.join_code.upper(), room, "join code")
+    if room.model.cr_activity_id > 0:
+        _add(rooms_by_cr_activity_id, room.model.cr_activity_id, room, "club room activity")
+    if room.game is not None:
+        register_game(room.game)
+
+
+def unregister_room(room: "RoomController"):
+    if rooms_by_name.get(room.name, None) is room:
+        del rooms_by_name[room.name]
+    code = room.model.join_code.upper()
+    if rooms_by_join_code.get(code, None) is room:
+        del rooms_by_join_code[code]
+    if rooms_by_cr_activity_id.get(room.model.cr_activity_id, None) is room:
+        del rooms_by_cr_activity_id[room.model.cr_activity_id]
+    if room.game is not None:
+        unregister_game(room.game)
+
+
+def set_cr_activity_id(room: "RoomController", activity_id: int):
+    room.model.cr_activity_id = activity_id
+    _add(rooms_by_cr_activity_id, activity_id, room, "club room activity")
+
+
+def register_game(game: "GameController"):
+    _add(games_by_name, game.name, game, "game")
+
+
+def unregister_game(game: "GameController"):
+    if games_by_name.get(game.name, None) is game:
+        del games_by_name[game.name]
+
+
+def room_by_join_code(code: str) -> "RoomController | None":
+    return rooms_by_join_code.get(code.upper(), None)
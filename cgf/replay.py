@@ -0,0 +1,77 @@
+from typing import Protocol, Sequence
+
+from cgf.binary_codec import packb
+from cgf.framing import MAX_FRAME_LEN, OutMsg
+
+
+CHUNK_TYPE = "GAME_REPLAY_CHUNK"
+CHUNK_PREFIX = b'{"type":"' + CHUNK_TYPE.encode("UTF8") + b'","payload":{"msgs":['
+CHUNK_SUFFIX = b']}}'
+# chunks have to fit in a legacy frame
+MAX_CHUNK_LEN = MAX_FRAME_LEN
+
+
+class Encoded(Protocol):
+    @property
+    def safe_json(self) -> dict: ...
+    @property
+    def encoded(self) -> bytes: ...
+    @property
+    def to_out_msg(self) -> OutMsg: ...
+
+
+class ReplayChunk(OutMsg):
+    ''' sent as msgpack to clients that negotiated it, like the game messages it carries '''
+    def __init__(self, msgs: list[Encoded]):
+        self.msgs = msgs
+        super().__init__({'type': CHUNK_TYPE}, json_body=CHUNK_PREFIX + b','.join(m.encoded for m in msgs) + CHUNK_SUFFIX)
+
+    def msgpack_body(self) -> bytes:
+        return packb({'type': CHUNK_TYPE, 'payload': {'msgs': [m.safe_json for m in self.msgs]}})
+
+
+class ReplayChunks:
+    '''
+    GAME_REPLAY_CHUNK messages for a game log whose messages are already JSON encoded. Each chunk
+    packs as many messages as fit in one frame. Full chunks never change, so they (and their encoded
+    frames, per wire format) are reused by later replays; only the last chunk is rebuilt after appends.
+    A message too big to fit in a chunk is sent as its own frame, in order, like a non-chunked replay.
+    Call `clear` if messages are removed from or inserted at the start of the log.
+    '''
+    sealed: list[OutMsg]
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.sealed = list()
+        # number of log messages in the sealed chunks
+        self.n_sealed = 0
+        self.tail: OutMsg | None = None
+        self.n_tail = 0
+
+    def chunks(self, log: Sequence[Encoded]) -> list[OutMsg]:
+        if self.n_sealed + self.n_tail != len(log):
+            self.extend(log)
+        return self.sealed if self.tail is None else self.sealed + [self.tail]
+
+    def extend(self, log: Sequence[Encoded]):
+        base_len = len(CHUNK_PREFIX) + len(CHUNK_SUFFIX)
+        msgs = list()
+        size = base_len
+        for i in range(self.n_sealed, len(log)):
+            body_len = len(log[i].encoded)
+            oversize = base_len + body_len > MAX_CHUNK_LEN
+            if len(msgs) > 0 and (oversize or size + body_len + 1 > MAX_CHUNK_LEN):
+                self.sealed.append(ReplayChunk(msgs))
+                self.n_sealed += len(msgs)
+                msgs = list()
+                size = base_len
+            if oversize:
+                self.sealed.append(log[i].to_out_msg)
+                self.n_sealed += 1
+                continue
+            msgs.append(log[i])
+            size += body_len + 1
+        self.tail = ReplayChunk(msgs) if len(msgs) > 0 else None
+        self.n_tail = len(msgs)
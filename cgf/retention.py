@@ -0,0 +1,203 @@
+'''
+How long we keep stored messages.
+
+- Message docs get an `expire_at` when they're persisted, based on their type, and a TTL index deletes them.
+  Messages from before this only get one if their type is listed explicitly.
+  Override per type with CGF_MESSAGE_RETENTION_DAYS, e.g. "MARK_READY=1,JOIN_ROOM=3,default=60" (0 = forever).
+- GameEvent and ChatLine docs older than ARCHIVE_AFTER_DAYS are streamed into gzipped JSONL files under
+  ARCHIVE_DIR/<collection>/<YYYY-MM-DD>.jsonl.gz (by the doc's `ts`, UTC) and then deleted.
+  `python -m cgf.retention restore <game name> [YYYY-MM-DD]` puts one game's events back.
+'''
+import asyncio
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+import gzip
+import logging
+import os
+from pathlib import Path
+import sys
+from typing import Iterator
+
+from bson import DBRef, ObjectId
+
+from cgf import json_codec
+
+
+DAY_SECS = 86400
+
+# days to keep each Message type; None = forever
+MESSAGE_RETENTION_DAYS: dict[str, float | None] = {
+    "MARK_READY": 3,
+    "JOIN_TEAM": 3,
+    "JOIN_ROOM": 7,
+    "JOIN_LOBBY": 7,
+    "JOIN_CODE": 7,
+    "JOIN_GAME_NOW": 7,
+    "LEAVE": 7,
+    "REGISTER": None,
+    "CREATE_LOBBY": None,
+    "CREATE_ROOM": None,
+    "default": 30,
+}
+
+
+def _parse_retention_overrides(spec: str):
+    for item in spec.split(','):
+        if '=' not in item: continue
+        msg_type, days = item.split('=', 1)
+        days = float(days)
+        MESSAGE_RETENTION_DAYS[msg_type.strip()] = None if days <= 0 else days
+
+_parse_retention_overrides(os.environ.get("CGF_MESSAGE_RETENTION_DAYS", ""))
+
+
+def message_expiry(msg_type: str, ts: float) -> datetime | None:
+    days = MESSAGE_RETENTION_DAYS.get(msg_type, MESSAGE_RETENTION_DAYS["default"])
+    if days is None: return None
+    return datetime.fromtimestamp(ts + days * DAY_SECS, tz=timezone.utc)
+
+
+ARCHIVE_DIR = Path(os.environ.get("CGF_ARCHIVE_DIR", "./archive"))
+ARCHIVE_AFTER_DAYS = float(os.environ.get("CGF_ARCHIVE_AFTER_DAYS", "14"))
+ARCHIVE_BATCH = 2000
+ARCHIVE_INTERVAL = DAY_SECS
+
+
+def _archive_default(obj):
+    if isinstance(obj, ObjectId):
+        return {"$oid": str(obj)}
+    if isinstance(obj, DBRef):
+        return {"$ref": obj.collection, "$id": {"$oid": str(obj.id)}}
+    if isinstance(obj, datetime):
+        return {"$date": obj.timestamp()}
+    raise TypeError(f"can't archive {type(obj)}")
+
+
+def _archive_object_hook(d: dict):
+    if len(d) == 1 and "$oid" in d:
+        return ObjectId(d["$oid"])
+    if len(d) == 1 and "$date" in d:
+        return datetime.fromtimestamp(d["$date"], tz=timezone.utc)
+    d = {k: _archive_object_hook(v) if isinstance(v, dict) else v for k, v in d.items()}
+    if "$ref" in d and "$id" in d:
+        return DBRef(d["$ref"], d["$id"])
+    return d
+
+
+def partition_path(collection: str, day: date) -> Path:
+    return ARCHIVE_DIR / collection / f"{day.isoformat()}.jsonl.gz"
+
+
+def _append_lines(collection: str, lines_by_day: dict[date, list[str]]):
+    for day, lines in lines_by_day.items():
+        path = partition_path(collection, day)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # each append is a new gzip member; gzip readers handle concatenated members
+        with gzip.open(path, 'at', encoding="UTF8") as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+async def archive_collection(collection, cutoff_ts: float) -> int:
+    '''
+    Stream docs with ts < cutoff_ts (sorted by ts) into the archive, deleting each batch once it's written.
+    `collection` is a motor collection, e.g. GameEvent.get_motor_collection().
+    '''
+    n_archived = 0
+    lines_by_day: dict[date, list[str]] = defaultdict(list)
+    ids = list()
+
+    async def flush():
+        nonlocal lines_by_day, ids, n_archived
+        if len(ids) == 0: return
+        await asyncio.to_thread(_append_lines, collection.name, lines_by_day)
+        await collection.delete_many({"_id": {"$in": ids}})
+        n_archived += len(ids)
+        lines_by_day, ids = defaultdict(list), list()
+
+    async for raw in collection.find({"ts": {"$lt": cutoff_ts}}).sort("ts", 1):
+        day = datetime.fromtimestamp(raw["ts"], tz=timezone.utc).date()
+        lines_by_day[day].append(json_codec.pydantic_dumps(raw, default=_archive_default))
+        ids.append(raw["_id"])
+        if len(ids) >= ARCHIVE_BATCH:
+            await flush()
+    await flush()
+    return n_archived
+
+
+async def archive_old_docs(collections: list) -> dict[str, int]:
+    cutoff = datetime.now(tz=timezone.utc).timestamp() - ARCHIVE_AFTER_DAYS * DAY_SECS
+    ret = dict()
+    for collection in collections:
+        try:
+            ret[collection.name] = await archive_collection(collection, cutoff)
+        except Exception as e:
+            logging.warning(f"[Archive] Failed archiving {collection.name}: {e}")
+    return ret
+
+
+async def backfill_message_expiry(collection) -> int:
+    '''
+    Set expire_at on Messages of the explicitly listed types that were stored before retention existed.
+    Older Messages of other types (game logs and chat from before GameEvent/ChatLine) are kept.
+    '''
+    n = 0
+    for msg_type, days in MESSAGE_RETENTION_DAYS.items():
+        if days is None or msg_type == "default": continue
+        query = {"expire_at": {"$exists": False}, "type": msg_type}
+        res = await collection.update_many(query, [{"$set": {"expire_at": {"$toDate": {"$multiply": [{"$add": ["$ts", days * DAY_SECS]}, 1000]}}}}])
+        n += res.modified_count
+    return n
+
+
+async def archive_loop(message_collection, archive_collections: list, interval: float = ARCHIVE_INTERVAL):
+    await asyncio.sleep(60 * 10)
+    n = await backfill_message_expiry(message_collection)
+    if n > 0:
+        logging.info(f"[Archive] Set expire_at on {n} older messages")
+    while True:
+        counts = await archive_old_docs(archive_collections)
+        logging.info(f"[Archive] Archived docs older than {ARCHIVE_AFTER_DAYS} days: {counts}")
+        await asyncio.sleep(interval)
+
+
+def read_archived(collection_name: str, days: list[date] | None = None, **match) -> Iterator[dict]:
+    ''' docs from the archive (all partitions unless `days` is given) whose fields equal `match` '''
+    if days is None:
+        paths = sorted((ARCHIVE_DIR / collection_name).glob("*.jsonl.gz"))
+    else:
+        paths = [partition_path(collection_name, d) for d in days]
+    for path in paths:
+        if not path.exists(): continue
+        with gzip.open(path, 'rt', encoding="UTF8") as f:
+            for line in f:
+                doc = _archive_object_hook(json_codec.loads(line))
+                if all(doc.get(k, None) == v for k, v in match.items()):
+                    yield doc
+
+
+async def restore_game(collection, game: str, day: date | None = None) -> int:
+    '''
+    Re-insert an archived game's events into `collection` (the GameEvent motor collection).
+    With `day`, only that partition and the next one are read (games can span midnight).
+    They're old, so the next archive run will move them back to the archive.
+    '''
+    days = None if day is None else [day, day + timedelta(days=1)]
+    docs = await asyncio.to_thread(lambda: sorted(read_archived(collection.name, days, game=game), key=lambda d: d["seq"]))
+    if len(docs) == 0: return 0
+    try:
+        await collection.insert_many(docs, ordered=False)
+    except Exception as e:
+        # events that are still in the collection are skipped (unique game/seq)
+        logging.warning(f"[Archive] Some events for {game} were not restored: {e}")
+    return len(docs)
+
+
+if __name__ == "__main__":
+    from cgf.db import db, MAIN_DB_NAME
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 3 or sys.argv[1] != "restore":
+        print("usage: python -m cgf.retention restore <game name> [YYYY-MM-DD]")
+        sys.exit(1)
+    day = None if len(sys.argv) < 4 else date.fromisoformat(sys.argv[3])
+    n = asyncio.run(restore_game(db[MAIN_DB_NAME]["GameEvent"], sys.argv[2], day))
+    print(f"Restored {n} events for game {sys.argv[2]}")
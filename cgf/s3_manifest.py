@@ -0,0 +1,155 @@
+'''
+Local record of which maps are in the S3 map cache, so startup doesn't have to list the whole bucket.
+
+The file is append-only: one TrackID per line for each map we put (or found) in the bucket, and
+`@<TrackID>` lines marking that the bucket has been listed up to that TrackID. On startup the file is read,
+then only keys for newer TrackIDs are listed (`list_objects_v2` with StartAfter, stopping at the newest
+known TrackID). Maps below the mark that some other process uploaded aren't listed; `is_map_cached`
+still finds those with a HEAD and records them. Recorded maps are buffered and appended every `FLUSH_SECS`
+from a worker thread, so caching maps never blocks the event loop on file writes.
+'''
+import asyncio
+import logging
+import os
+from pathlib import Path
+import time
+
+
+MANIFEST_PATH = Path(os.environ.get("CGF_S3_MANIFEST", "./s3_manifest.txt"))
+MAP_KEY_SUFFIX = ".Map.Gbx"
+FLUSH_SECS = 5.0
+
+
+def key_to_track_id(key: str) -> int | None:
+    try:
+        return int(key.split(MAP_KEY_SUFFIX)[0])
+    except ValueError:
+        return None
+
+
+class CacheManifest:
+    # recorded TrackIDs not written to the file yet
+    pending: list[int]
+
+    def __init__(self, path: Path = MANIFEST_PATH, flush_secs: float = FLUSH_SECS):
+        self.path = path
+        self.flush_secs = flush_secs
+        # the bucket has been listed for TrackIDs up to this
+        self.listed_up_to: int | None = None
+        self.pending = list()
+        self.lock = asyncio.Lock()
+        self.task: asyncio.Task | None = None
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def load(self) -> set[int]:
+        start = time.time()
+        track_ids = set()
+        for line in self.path.read_text().splitlines():
+            if line.startswith('@'):
+                self.listed_up_to = int(line[1:])
+            elif len(line) > 0:
+                track_ids.add(int(line))
+        logging.info(f"Loaded S3 cache manifest: {len(track_ids)} maps in {(time.time() - start) * 1000:.0f} ms")
+        return track_ids
+
+    def record(self, track_id: int):
+        self.pending.append(track_id)
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_secs)
+            await self.flush()
+
+    def _append_blocking(self, lines: list[str]):
+        with self.path.open('a') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    async def _append(self, track_ids: list[int], marker: int | None = None) -> bool:
+        ''' call with the lock held; on failure the TrackIDs go back to `pending` '''
+        lines = [str(tid) for tid in track_ids]
+        if marker is not None:
+            lines.append(f"@{marker}")
+        if len(lines) == 0: return True
+        try:
+            await asyncio.to_thread(self._append_blocking, lines)
+            return True
+        except Exception as e:
+            logging.warning(f"Failed to append {len(lines)} lines to S3 cache manifest, retrying next flush: {e}")
+            self.pending[:0] = track_ids
+            return False
+
+    async def flush(self):
+        async with self.lock:
+            if len(self.pending) == 0: return
+            batch, self.pending = self.pending, list()
+            await self._append(batch)
+
+    async def record_listing(self, track_ids: set[int], listed_up_to: int | None):
+        async with self.lock:
+            # the mark is written together with the maps listed under it; if that fails the next reconcile lists them again
+            batch, self.pending = self.pending + list(track_ids), list()
+            if await self._append(batch, listed_up_to) and listed_up_to is not None:
+                self.listed_up_to = listed_up_to
+
+    async def rewrite(self, track_ids: set[int], listed_up_to: int | None):
+        ''' replace the file with exactly these maps (after a full listing); `track_ids` must include every recorded map '''
+        async with self.lock:
+            lines = [str(tid) for tid in sorted(track_ids)]
+            if listed_up_to is not None:
+                lines.append(f"@{listed_up_to}")
+            await asyncio.to_thread(self._replace_blocking, lines)
+            self.pending = [tid for tid in self.pending if tid not in track_ids]
+            self.listed_up_to = listed_up_to
+
+    def _replace_blocking(self, lines: list[str]):
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text('\n'.join(lines) + '\n')
+        tmp.replace(self.path)
+
+    def list_new_keys_blocking(self, s3_client, bucket: str, up_to: int, stop=lambda: False, log_progress=False) -> tuple[set[int], int | None]:
+        '''
+        TrackIDs in the bucket that are > `listed_up_to` and <= `up_to` (the whole bucket if `listed_up_to` is None),
+        and the TrackID the bucket is now listed up to.
+        '''
+        paginator = s3_client.get_paginator('list_objects_v2')
+        if self.listed_up_to is None:
+            track_ids = set()
+            for i, page in enumerate(paginator.paginate(Bucket=bucket)):
+                if stop(): return track_ids, None
+                for obj in page.get('Contents', []):
+                    tid = key_to_track_id(obj['Key'])
+                    if tid is not None:
+                        track_ids.add(tid)
+                if log_progress and i % 10 == 9:
+                    logging.info(f"Listing cached maps... {len(track_ids)} / ???")
+            return track_ids, max(track_ids, default=None)
+        track_ids = set()
+        for lo, hi in id_ranges(self.listed_up_to + 1, up_to):
+            # keys sort as strings; within one digit count that's numeric order, so list from lo and stop after hi
+            end_key = f"{hi}{MAP_KEY_SUFFIX}"
+            for page in paginator.paginate(Bucket=bucket, StartAfter=str(lo)):
+                if stop(): return track_ids, self.listed_up_to
+                keys = [obj['Key'] for obj in page.get('Contents', [])]
+                for key in keys:
+                    tid = key_to_track_id(key)
+                    if tid is not None and lo <= tid <= hi:
+                        track_ids.add(tid)
+                if len(keys) == 0 or keys[-1] >= end_key: break
+        return track_ids, max(up_to, self.listed_up_to)
+
+
+def id_ranges(lo: int, hi: int) -> list[tuple[int, int]]:
+    ''' split [lo, hi] into ranges of ids with the same number of digits '''
+    ranges = list()
+    while lo <= hi:
+        end = min(hi, 10 ** len(str(lo)) - 1)
+        ranges.append((lo, end))
+        lo = end + 1
+    return ranges
+
+
+manifest = CacheManifest()
@@ -0,0 +1,71 @@
+import asyncio
+from dataclasses import dataclass
+import itertools
+import logging
+import traceback
+from typing import Callable
+
+
+# a tick callback returning False is removed from the wheel
+TickFn = Callable[[], bool | None]
+
+
+@dataclass
+class TickHandle:
+    slot: int
+    id: int
+
+
+class TimingWheel:
+    '''
+    Calls every registered callback once per `period`, from a single task.
+    The period is split into `n_slots` slots and each callback is put into the least loaded slot,
+    so a burst of new clients is spread across the period rather than all firing together.
+    '''
+    period: float
+    slots: list[dict[int, TickFn]]
+
+    def __init__(self, period: float = 5.0, n_slots: int = 50):
+        self.period = period
+        self.n_slots = n_slots
+        self.slots = [dict() for _ in range(n_slots)]
+        self.curr_slot = 0
+        self.ids = itertools.count()
+        self.task: asyncio.Task | None = None
+
+    def __len__(self):
+        return sum(len(s) for s in self.slots)
+
+    def add(self, fn: TickFn) -> TickHandle:
+        slot = min(range(self.n_slots), key=lambda i: len(self.slots[i]))
+        handle = TickHandle(slot, next(self.ids))
+        self.slots[slot][handle.id] = fn
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return handle
+
+    def remove(self, handle: TickHandle):
+        self.slots[handle.slot].pop(handle.id, None)
+
+    def run_slot(self, slot: dict[int, TickFn]):
+        for id, fn in list(slot.items()):
+            try:
+                if fn() is False:
+                    slot.pop(id, None)
+            except Exception as e:
+                slot.pop(id, None)
+                logging.warning(f"Exception in tick callback (removed): {e}\n{''.join(traceback.format_exception(e))}")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        slot_secs = self.period / self.n_slots
+        next_at = loop.time()
+        while True:
+            self.run_slot(self.slots[self.curr_slot])
+            self.curr_slot = (self.curr_slot + 1) % self.n_slots
+            next_at += slot_secs
+            await asyncio.sleep(max(0, next_at - loop.time()))
+
+
+# process-wide wheel for per-client periodic work (pings, lobby/room/game info)
+wheel = TimingWheel()
@@ -0,0 +1,67 @@
+import asyncio
+import time
+from typing import Callable
+
+
+_MISSING = object()
+
+# `refresh` re-diffs at most this often
+REFRESH_SECS = 5.0
+
+
+class VersionedState:
+    '''
+    Versioned snapshot of a container's (lobby/room/game) state.
+
+    The snapshot is a flat dict; on a change it's diffed against the last published snapshot and,
+    if anything differs, the version is bumped and `on_delta` gets `{v, prev, set, rm}` where `set`
+    holds changed/new keys and `rm` lists removed keys. Clients apply a delta only if `prev` matches
+    their version, and ask for a full snapshot (STATE_RESYNC) if they see a gap.
+    '''
+    version: int
+    last: dict
+
+    def __init__(self, snapshot_fn: Callable[[], dict], on_delta: Callable[[dict], None]):
+        self.snapshot_fn = snapshot_fn
+        self.on_delta = on_delta
+        self.version = 0
+        self.last = dict()
+        self.last_diff_at = 0.0
+        self.publish_scheduled = False
+
+    def changed(self):
+        ''' Note that the state (probably) changed. Changes in the same loop iteration are published as one delta. '''
+        if self.publish_scheduled: return
+        self.publish_scheduled = True
+        asyncio.get_running_loop().call_soon(self.publish)
+
+    def publish(self):
+        self.publish_scheduled = False
+        delta = self.diff()
+        if delta is not None:
+            self.on_delta(delta)
+
+    def refresh(self):
+        ''' Catch changes that didn't call `changed` (e.g. time-based fields), without re-diffing more than every REFRESH_SECS. '''
+        if time.time() - self.last_diff_at >= REFRESH_SECS:
+            self.publish()
+
+    def diff(self) -> dict | None:
+        self.last_diff_at = time.time()
+        new = self.snapshot_fn()
+        last = self.last
+        changed = {k: v for k, v in new.items() if last.get(k, _MISSING) != v}
+        removed = [k for k in last if k not in new]
+        if len(changed) == 0 and len(removed) == 0:
+            return None
+        prev = self.version
+        self.version += 1
+        self.last = new
+        return dict(v=self.version, prev=prev, set=changed, rm=removed)
+
+    @property
+    def to_state_json(self) -> dict:
+        ''' full snapshot, for clients that just joined or asked to resync '''
+        if self.publish_scheduled or self.version == 0:
+            self.publish()
+        return dict(v=self.version, state=self.last)
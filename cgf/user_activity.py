@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import time
+
+from beanie import Document
+from pymongo import UpdateOne
+
+
+FLUSH_SECS = 5.0
+
+
+class UserActivityBuffer:
+    '''
+    Buffers per-user activity fields (last_seen, last_scope, n_logins, name) and writes them for all
+    users at once with an unordered bulk_write every `flush_secs`. Values are read from the user when
+    flushing, so any number of updates in between cost one write per user.
+    '''
+    # user uid -> (user, fields to $set)
+    pending: dict[str, tuple[Document, set[str]]]
+
+    def __init__(self, flush_secs: float = FLUSH_SECS):
+        self.flush_secs = flush_secs
+        self.pending = dict()
+        self.lock = asyncio.Lock()
+        self.task: asyncio.Task | None = None
+        self.n_touches = 0
+        self.n_writes = 0
+
+    def touch(self, user: Document, *fields: str):
+        self.n_touches += 1
+        entry = self.pending.get(user.uid, None)
+        if entry is None:
+            self.pending[user.uid] = (user, set(fields))
+        else:
+            entry[1].update(fields)
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_secs)
+            await self.flush()
+
+    def requeue(self, batch: dict[str, tuple[Document, set[str]]]):
+        for uid, (user, fields) in batch.items():
+            entry = self.pending.get(uid, None)
+            if entry is None:
+                self.pending[uid] = (user, fields)
+            else:
+                entry[1].update(fields)
+
+    async def flush(self):
+        async with self.lock:
+            if len(self.pending) == 0: return
+            batch, self.pending = self.pending, dict()
+            # users that aren't inserted yet keep their updates until they have an id
+            unsaved = {uid: entry for uid, entry in batch.items() if entry[0].id is None}
+            if len(unsaved) > 0:
+                self.requeue(unsaved)
+                batch = {uid: entry for uid, entry in batch.items() if uid not in unsaved}
+                logging.debug(f"[UserActivity] Holding updates for {len(unsaved)} users without an id")
+            ops = [UpdateOne({"_id": user.id}, {"$set": {f: getattr(user, f) for f in fields}})
+                for user, fields in batch.values()]
+            if len(ops) == 0: return
+            collection = next(iter(batch.values()))[0].get_motor_collection()
+            start = time.time()
+            try:
+                await collection.bulk_write(ops, ordered=False)
+                self.n_writes += len(ops)
+            except Exception as e:
+                logging.warning(f"[UserActivity] bulk_write of {len(ops)} updates failed, retrying next flush: {e}")
+                self.requeue(batch)
+                return
+            logging.debug(f"[UserActivity] Wrote {len(ops)} users in {(time.time() - start) * 1000:.1f} ms ({self.n_touches} touches, {self.n_writes} writes total)")
+
+
+user_activity = UserActivityBuffer()
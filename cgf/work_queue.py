@@ -0,0 +1,115 @@
+'''
+A keyed priority work queue served by a fixed pool of workers, and a rate limiter.
+Used for downloading maps into the S3 cache (see RandomMapCacher).
+'''
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Hashable
+
+
+class RateLimiter:
+    ''' at most `per_sec` acquisitions per second, spaced evenly '''
+    def __init__(self, per_sec: float):
+        self.interval = 1.0 / per_sec
+        self.next_at = 0.0
+
+    async def acquire(self):
+        now = time.monotonic()
+        wait = self.next_at - now
+        self.next_at = max(now, self.next_at) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class PriorityWorkQueue:
+    '''
+    Runs `work(key)` for queued keys on `n_workers` workers, lowest priority number first (FIFO within a priority).
+    A key is queued at most once and never runs twice at the same time; queueing it again only raises its priority.
+    Failed work is retried with exponential backoff (at the same priority) up to `max_retries` times.
+    '''
+    # (priority, seq, key); entries whose priority doesn't match `queued` are stale and skipped
+    heap: list[tuple[int, int, Hashable]]
+    # key -> priority it's queued at
+    queued: dict[Hashable, int]
+    in_flight: set[Hashable]
+    # key -> failed attempts so far
+    attempts: dict[Hashable, int]
+
+    def __init__(self, name: str, work: Callable[[Hashable], Awaitable], n_workers: int = 4,
+                 max_retries: int = 5, backoff_base: float = 5.0, backoff_max: float = 600.0):
+        self.name = name
+        self.work = work
+        self.n_workers = n_workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.heap = list()
+        self.queued = dict()
+        self.in_flight = set()
+        self.attempts = dict()
+        self.seq = itertools.count()
+        self.has_work = asyncio.Event()
+        self.workers: list[asyncio.Task] = list()
+        self.n_done = 0
+        self.n_failed = 0
+
+    def __len__(self):
+        return len(self.queued)
+
+    def put(self, key: Hashable, priority: int):
+        current = self.queued.get(key, None)
+        if current is not None and current <= priority: return
+        if key in self.in_flight: return
+        self.queued[key] = priority
+        heapq.heappush(self.heap, (priority, next(self.seq), key))
+        self.has_work.set()
+        if len(self.workers) == 0:
+            self.workers = [asyncio.create_task(self.worker()) for _ in range(self.n_workers)]
+
+    def put_many(self, keys, priority: int):
+        for key in keys:
+            self.put(key, priority)
+
+    def pop(self) -> tuple[int, Hashable] | None:
+        while len(self.heap) > 0:
+            priority, _, key = heapq.heappop(self.heap)
+            if self.queued.get(key, None) == priority:
+                del self.queued[key]
+                return priority, key
+        return None
+
+    async def worker(self):
+        while True:
+            item = self.pop()
+            if item is None:
+                self.has_work.clear()
+                await self.has_work.wait()
+                continue
+            priority, key = item
+            self.in_flight.add(key)
+            try:
+                await self.work(key)
+                self.attempts.pop(key, None)
+                self.n_done += 1
+            except Exception as e:
+                self.retry_later(key, priority, e)
+            finally:
+                self.in_flight.discard(key)
+
+    def retry_later(self, key: Hashable, priority: int, e: Exception):
+        n = self.attempts.get(key, 0) + 1
+        if n > self.max_retries:
+            self.attempts.pop(key, None)
+            self.n_failed += 1
+            logging.warning(f"[{self.name}] Giving up on {key} after {n} attempts: {e}")
+            return
+        self.attempts[key] = n
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (n - 1))
+        logging.info(f"[{self.name}] {key} failed ({e}); retry {n}/{self.max_retries} in {delay:.0f}s")
+        asyncio.get_event_loop().call_later(delay, self.put, key, priority)
+
+    def stats_report(self) -> str:
+        return f"{len(self.queued)} queued, {len(self.in_flight)} in flight, {self.n_done} done, {self.n_failed} failed, {len(self.attempts)} retrying"
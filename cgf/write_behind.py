@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+
+from beanie import Document, PydanticObjectId
+from pymongo.errors import BulkWriteError
+
+
+# flush once this many documents are queued, or this long after the first one was queued
+BATCH_SIZE = 200
+FLUSH_SECS = 0.5
+# a document that fails to insert this many times is dropped
+MAX_ATTEMPTS = 5
+
+
+class WriteBehind:
+    '''
+    Queues new documents for one collection and inserts them in batches with insert_many,
+    so callers never wait on the database. Documents get their id when queued, so they can be
+    referenced (e.g. from a GameSession) straight away. Documents that fail to insert are queued
+    again with the next batch, up to `max_attempts` times.
+    '''
+    pending: list[Document]
+    # doc id -> failed inserts so far
+    attempts: dict[PydanticObjectId, int]
+
+    def __init__(self, doc_cls: type[Document], batch_size: int = BATCH_SIZE, flush_secs: float = FLUSH_SECS, max_attempts: int = MAX_ATTEMPTS):
+        self.doc_cls = doc_cls
+        self.batch_size = batch_size
+        self.flush_secs = flush_secs
+        self.max_attempts = max_attempts
+        self.pending = list()
+        self.attempts = dict()
+        self.flush_handle: asyncio.TimerHandle | None = None
+        self.inserting: set[asyncio.Task] = set()
+        self.n_docs = 0
+        self.n_batches = 0
+        self.n_dropped = 0
+
+    def put(self, doc: Document):
+        if doc.id is None:
+            doc.id = PydanticObjectId()
+        self.pending.append(doc)
+        if len(self.pending) >= self.batch_size:
+            self.flush_now()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.flush_secs, self.flush_now)
+
+    def flush_now(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if len(self.pending) == 0: return
+        batch, self.pending = self.pending, list()
+        task = asyncio.create_task(self.insert_batch(batch))
+        self.inserting.add(task)
+        task.add_done_callback(self.inserting.discard)
+
+    async def insert_batch(self, batch: list[Document]):
+        start = time.time()
+        try:
+            await self.doc_cls.insert_many(batch, ordered=False)
+            failed = list()
+        except BulkWriteError as e:
+            # a duplicate key means the doc is already there (e.g. an earlier attempt got through before timing out)
+            errors = [err for err in e.details.get("writeErrors", []) if err.get("code", None) != 11000]
+            failed = [batch[err["index"]] for err in errors]
+            if len(failed) > 0:
+                logging.warning(f"[WriteBehind:{self.doc_cls.__name__}] Failed to insert {len(failed)} of {len(batch)}: {errors[0].get('errmsg', errors[0])}")
+        except Exception as e:
+            # we don't know which got through; the ones that did fail with a duplicate key next time
+            failed = batch
+            logging.warning(f"[WriteBehind:{self.doc_cls.__name__}] Failed to insert batch of {len(batch)}: {e}")
+        failed_ids = {doc.id for doc in failed}
+        for doc in batch:
+            if doc.id not in failed_ids:
+                self.attempts.pop(doc.id, None)
+        self.n_docs += len(batch) - len(failed)
+        self.n_batches += 1
+        self.retry_later(failed)
+        logging.debug(f"[WriteBehind:{self.doc_cls.__name__}] Inserted {len(batch) - len(failed)} in {(time.time() - start) * 1000:.1f} ms")
+
+    def retry_later(self, failed: list[Document]):
+        retry = list()
+        for doc in failed:
+            n = self.attempts.get(doc.id, 0) + 1
+            if n >= self.max_attempts:
+                self.n_dropped += 1
+                logging.error(f"[WriteBehind:{self.doc_cls.__name__}] Dropping {doc.id} after {n} failed inserts")
+                continue
+            self.attempts[doc.id] = n
+            retry.append(doc)
+        if len(retry) == 0: return
+        self.pending[:0] = retry
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.flush_secs, self.flush_now)
+
+    async def flush(self):
+        ''' insert everything queued so far and wait for it, including retries (e.g. on shutdown) '''
+        while True:
+            self.flush_now()
+            if len(self.inserting) == 0: return
+            await asyncio.gather(*self.inserting, return_exceptions=True)
@@ -9,7 +9,13 @@ import signal
 import urllib3
 import threading
 
-from cgf.Client import Client, ChatMessages, Lobby, LobbyModel, Message, Room, GameSession, get_main_lobby, all_clients, populate_all_lobbies, all_lobbies
+from cgf.Client import Client, ChatLine, Lobby, LobbyModel, Message, Room, GameSession, GameEvent, GameSnapshot, get_main_lobby, all_clients, populate_all_lobbies, all_lobbies, \
+    message_writer, game_event_writer, chat_writer, log_outbound_stats_loop
+from cgf.connection import FrameProtocol
+import cgf.compression as compression
+import cgf.persistence as persistence
+from cgf.user_activity import user_activity
+from cgf.s3_manifest import manifest
 from cgf.NadeoApi import run_club_room_creation_test, run_nadeo_services_auth
 import cgf.RandomMapCacher as RMC
 from cgf.User import User
@@ -19,7 +25,9 @@ from cgf.users import all_users
 from cgf.consts import LOCAL_DEV_MODE, SERVER_VERSION, SHUTDOWN, SHUTDOWN_EVT
 from cgf.models.Map import Map
 from cgf.users import all_users
-from cgf.db import db
+from cgf.db import db, MAIN_DB_NAME
+import cgf.retention as retention
+import cgf.migrations as migrations
 from cgf.utils import timeit_context
 # log.basicConfig(level=log.DEBUG)
 log.basicConfig(
@@ -59,18 +67,33 @@ def cleanup_clients(*args):
     all_clients.clear()
     del _clients
     log.info(f"Disconnected all clients")
-    sys.exit(0)
 
 
-MAIN_INIT_DONE = False
+async def flush_pending_writes():
+    with timeit_context("Flush pending writes"):
+        await persistence.flusher.flush()
+        for writer in (message_writer, game_event_writer, chat_writer):
+            await writer.flush()
+        await user_activity.flush()
+        await manifest.flush()
+    log.info(f"Dirty document writes: {persistence.flusher.stats_report()}")
 
-MAIN_DB_NAME = os.environ.get("CGF_DB_NAME", "cgf_db")
+
+def on_shutdown_signal():
+    if not MAIN_INIT_DONE.is_set():
+        # nothing to flush yet
+        cleanup_clients()
+        sys.exit(0)
+    SHUTDOWN_REQUESTED.set()
+
+
+MAIN_INIT_DONE = asyncio.Event()
+SHUTDOWN_REQUESTED = asyncio.Event()
 
 
 async def main():
-    global MAIN_INIT_DONE
-    signal.signal(signal.SIGTERM, cleanup_clients)
-    signal.signal(signal.SIGINT, cleanup_clients)
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_running_loop().add_signal_handler(sig, on_shutdown_signal)
 
     log.info(f"[version: {SERVER_VERSION}] Starting server: {HOST_NAME}:{TCP_PORT}")
     asyncio.create_task(run_nadeo_services_auth())
@@ -81,12 +104,15 @@ async def main():
     with timeit_context("init_beanie"):
         await init_beanie(database=db[MAIN_DB_NAME], document_models=[
             User, Message, LobbyModel,
-            ChatMessages,
-            Room, GameSession,
+            ChatLine,
+            Room, GameSession, GameEvent, GameSnapshot,
             Map, MapPack,
             RandomMapQueue,
         ], allow_index_dropping=True)
 
+    with timeit_context("Migrate game messages"):
+        await migrations.migrate_game_msgs()
+
     with timeit_context("Load cached fresh maps"):
         await RMC.init_fresh_maps_from_db()
 
@@ -94,6 +120,8 @@ async def main():
         async for user in User.find_all():
             all_users[user.uid] = user
     log.info(f"Loaded {len(all_users)} users")
+    with timeit_context("Migrate recent chat"):
+        await migrations.migrate_recent_chat(all_users)
     # asyncio.create_task(get_main_lobby())  # init main lobby
     with timeit_context("Load lobbies"):
         await populate_all_lobbies()
@@ -120,6 +148,10 @@ async def main():
         log.info(f"Getting latest maps from TMX")
         await RMC.add_latest_maps()
 
+    asyncio.create_task(compression.log_stats_loop())
+    asyncio.create_task(persistence.log_stats_loop())
+    asyncio.create_task(log_outbound_stats_loop())
+    asyncio.create_task(retention.archive_loop(Message.get_motor_collection(), [GameEvent.get_motor_collection(), ChatLine.get_motor_collection()]))
     asyncio.create_task(RMC.maintain_random_maps())
     asyncio.create_task(RMC.maintain_totd_maps())
 
@@ -131,21 +163,25 @@ async def main():
     log.info(f"Loaded {count_rooms} total rooms with {count_games} total games")
 
 
-    MAIN_INIT_DONE = True
+    MAIN_INIT_DONE.set()
 
     # start socket server and run forever
-    server = await asyncio.start_server(connection_cb, HOST_NAME, TCP_PORT)
+    server = await asyncio.get_running_loop().create_server(
+        lambda: FrameProtocol(lambda conn: asyncio.create_task(connection_cb(conn))),
+        HOST_NAME, TCP_PORT)
     async with server:
-        await server.serve_forever()
+        await SHUTDOWN_REQUESTED.wait()
 
     cleanup_clients()
+    # let client tasks handle their disconnects (e.g. GM_PLAYER_LEFT) before the final flush
+    await asyncio.sleep(0.5)
+    await flush_pending_writes()
 
 
 
-async def connection_cb(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    while not MAIN_INIT_DONE:
-        await asyncio.sleep(0.05)
-    c = Client(reader, writer)
+async def connection_cb(conn: FrameProtocol):
+    await MAIN_INIT_DONE.wait()
+    c = Client(conn)
     try:
         await c.main_loop()
     except Exception as e: